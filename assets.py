@@ -0,0 +1,150 @@
+"""
+Fingerprinted, precompressed static files.
+
+At startup every file under the static directory is read into memory, hashed, and
+compressed with gzip and brotli where that makes it smaller (gzip only if the Brotli
+package from requirements.txt is missing). Each file is served under a fingerprinted
+name with the content hash in it (main.css -> main.3f2a9c1b7d4e.css). Fingerprinted
+URLs change whenever the content does, so they are served with an immutable one-year
+Cache-Control and a browser never asks for them again. Templates get the fingerprinted
+URL from the `asset()` helper:
+
+    <link rel="stylesheet" href="{{ asset('main.css') }}">
+
+The original names still work, but are served with `no-cache`, i.e. revalidated with
+the ETag on every use. Changes to the files are picked up on restart.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+from starlette.datastructures import Headers
+from starlette.responses import PlainTextResponse, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/xml",
+    "image/svg+xml", "application/manifest+json")
+
+
+class Asset:
+    __slots__ = ("content_type", "variants")
+
+    def __init__(self, content_type, variants):
+        self.content_type = content_type
+        self.variants = variants # encoding ("identity", "gzip", "br") -> (body, etag)
+
+
+def fingerprint(path, digest):
+    root, ext = os.path.splitext(path)
+    return f"{root}.{digest[:12]}{ext}"
+
+
+def accepted_encodings(header):
+    accepted = set()
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if q > 0:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+class StaticAssets:
+    """ASGI app serving the files in `directory`, to be mounted at `prefix`."""
+
+    def __init__(self, directory, prefix="/static", min_compress_size=256):
+        self.directory = directory
+        self.prefix = prefix.rstrip("/")
+        self.min_compress_size = min_compress_size
+        self.urls = {} # path -> fingerprinted path
+        self._assets = {} # path or fingerprinted path -> (Asset, cache control)
+        self.build()
+
+    def build(self):
+        urls = {}
+        assets = {}
+        for root, dirs, files in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for filename in files:
+                if filename.startswith("."):
+                    continue
+                full_path = os.path.join(root, filename)
+                path = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+                with open(full_path, "rb") as f:
+                    body = f.read()
+                asset = self._asset(path, body)
+                digest = asset.variants["identity"][1].strip('"')
+                urls[path] = fingerprint(path, digest)
+                assets[urls[path]] = (asset, IMMUTABLE)
+                assets[path] = (asset, REVALIDATE)
+        self.urls, self._assets = urls, assets
+
+    def _asset(self, path, body):
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        variants = {"identity": (body, f'"{digest}"')}
+        if len(body) >= self.min_compress_size and content_type.startswith(COMPRESSIBLE_TYPES):
+            # Worth it only if it saves at least a tenth
+            compressed = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(compressed) < len(body) * 0.9:
+                variants["gzip"] = (compressed, f'"{digest}-gzip"')
+            if brotli is not None:
+                compressed = brotli.compress(body, quality=11)
+                if len(compressed) < len(body) * 0.9:
+                    variants["br"] = (compressed, f'"{digest}-br"')
+        if content_type == "application/javascript": # Starlette adds it for text/*
+            content_type += "; charset=utf-8"
+        return Asset(content_type, variants)
+
+    def url(self, path):
+        """The fingerprinted URL of `path` (relative to the static directory). Unknown
+        paths get their plain URL, so a missing file shows up as a 404 in the browser
+        rather than as a template error.
+        """
+        return f"{self.prefix}/{self.urls.get(path, path)}"
+
+    async def __call__(self, scope, receive, send):
+        # Depending on the Starlette version, the mount prefix is either stripped from
+        # `path` or only present in `root_path`.
+        path = scope["path"]
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        if scope["method"] not in ("GET", "HEAD"):
+            response = PlainTextResponse("Method Not Allowed", status_code=405)
+        else:
+            entry = self._assets.get(path.lstrip("/"))
+            if entry is None:
+                response = PlainTextResponse("Not Found", status_code=404)
+            else:
+                response = self._response(Headers(scope=scope), *entry)
+        await response(scope, receive, send)
+
+    def _response(self, request_headers, asset, cache_control):
+        encodings = accepted_encodings(request_headers.get("accept-encoding", ""))
+        encoding = next((e for e in ("br", "gzip") if e in asset.variants and e in encodings), "identity")
+        body, etag = asset.variants[encoding]
+        headers = {"ETag": etag, "Cache-Control": cache_control}
+        if len(asset.variants) > 1:
+            headers["Vary"] = "Accept-Encoding"
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if etag in tags or "*" in tags:
+                return Response(status_code=304, headers=headers)
+        return Response(body, media_type=asset.content_type, headers=headers)
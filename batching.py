@@ -0,0 +1,73 @@
+"""
+Micro-batching of concurrent lookups into bulk upstream calls.
+
+With many different users active at once, each request looks up its own user and
+`SingleFlight` has nothing to share. FusionAuth can return many users from one search
+by ids, though. `MicroBatcher` collects the keys requested within a short window (or up
+to a maximum batch size), fetches them with a single call and hands each caller its own
+result.
+"""
+import asyncio
+
+
+class MicroBatcher:
+
+    def __init__(self, fetch_many, window=0.002, max_batch=100):
+        """`fetch_many` is an async function taking a list of keys and returning a dict
+        of key -> result. Keys it leaves out get None. A batch is sent `window` seconds
+        after its first key arrived, or as soon as it has `max_batch` keys.
+        """
+        self.fetch_many = fetch_many
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0 # upstream calls made
+        self.keys = 0 # keys looked up in them
+        self._pending = {} # key -> Future, for the batch being collected
+        self._timer = None
+
+    async def load(self, key):
+        """Return the result for `key`, fetched as part of a batch. An exception raised
+        by `fetch_many` is raised to every caller in the batch.
+        """
+        future = self._pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending[key] = future
+            if len(self._pending) >= self.max_batch:
+                self._dispatch()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.window, self._dispatch)
+        # Shielded so that one caller going away does not fail the lookup for others
+        # waiting on the same key.
+        return await asyncio.shield(future)
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            self.batches += 1
+            self.keys += len(batch)
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        try:
+            results = await self.fetch_many(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+                    future.exception() # mark it retrieved, in case all its callers went away
+            return
+        except BaseException:
+            for future in batch.values():
+                future.cancel()
+            raise
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(results.get(key))
+
+    def stats(self):
+        return {"batches": self.batches, "keys": self.keys}
@@ -0,0 +1,303 @@
+"""
+Load test / benchmark for the auth hot paths, run against fake_fusionauth.py.
+
+For each combination of session mode (USE_TOKENS off/on) and session store, this
+starts a fake FusionAuth and the app under uvicorn, then drives these scenarios at the
+given concurrency:
+
+- login: POST /login-form with a fresh client
+- page: GET / as a logged in user
+- register: POST /register with a new email
+- logout: GET /logout for a logged in user
+
+It reports throughput, p50/p95/p99 latency and FusionAuth calls per request as JSON.
+Pass a previous run's output with --compare to flag regressions; the exit status is 1
+if any were found.
+
+    python bench.py --requests 2000 --concurrency 50 --output bench.json
+    python bench.py --compare bench.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import httpx
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ["login", "page", "register", "logout"]
+API_KEY = "fake-api-key"
+CLIENT_ID = "fake-client-id"
+CLIENT_SECRET = "fake-client-secret"
+HMAC_SECRET = "fake-hmac-secret-for-local-benchmarks"
+PASSWORD = "password"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_for(url, timeout=20):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{url} did not come up")
+                await asyncio.sleep(0.1)
+
+
+@contextlib.asynccontextmanager
+async def servers(args, use_tokens, store, workdir):
+    fake_port = free_port()
+    app_port = free_port()
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(HERE, "fake_fusionauth.py"),
+        "--port", str(fake_port),
+        "--api-key", API_KEY,
+        "--client-id", CLIENT_ID,
+        "--client-secret", CLIENT_SECRET,
+        "--hmac-secret", HMAC_SECRET,
+        "--users", str(args.users),
+        "--jwt-ttl", str(args.jwt_ttl),
+        "--latency-ms", str(args.fake_latency_ms),
+        "--jitter-ms", str(args.fake_jitter_ms),
+        "--error-rate", str(args.fake_error_rate),
+    ])
+    env = dict(
+        os.environ,
+        FUSIONAUTH_API_KEY=API_KEY,
+        FUSIONAUTH_CLIENT_ID=CLIENT_ID,
+        FUSIONAUTH_CLIENT_SECRET=CLIENT_SECRET,
+        FUSIONAUTH_JWT_HMAC_SECRET=HMAC_SECRET,
+        FUSIONAUTH_HOST_IP="127.0.0.1",
+        FUSIONAUTH_HOST_PORT=str(fake_port),
+        USE_TOKENS="true" if use_tokens else "false",
+        SESSION_STORE=store,
+        SESSION_DIR=os.path.join(workdir, "sessions"),
+        SESSION_DB=os.path.join(workdir, "sessions.db"),
+        REVOCATION_DB=os.path.join(workdir, "revocations.db"),
+        TEMPLATE_CACHE_DIR=os.path.join(workdir, "templates_cache"),
+    )
+    app = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--port", str(app_port),
+        "--workers", str(args.workers),
+        "--log-level", "warning",
+        "--no-access-log",
+    ], cwd=HERE, env=env)
+    try:
+        fake_url = f"http://127.0.0.1:{fake_port}"
+        app_url = f"http://127.0.0.1:{app_port}"
+        await wait_for(fake_url + "/_stats")
+        await wait_for(app_url + "/static/")
+        yield app_url, fake_url
+    finally:
+        for proc in (app, fake):
+            proc.terminate()
+        for proc in (app, fake):
+            proc.wait()
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def email_for(i, args):
+    return f"user{i % args.users}@example.com"
+
+
+async def login(client, email):
+    resp = await client.post("/login-form", data={"email": email, "password": PASSWORD})
+    return resp.status_code == 303
+
+
+async def run_scenario(scenario, app_url, fake_url, args):
+    # Every virtual user has its own client (cookie jar), but they all share one
+    # connection pool. Creating a client with its own transport is expensive enough
+    # (SSL context setup) to dominate the measurements.
+    transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=args.concurrency))
+    new_client = lambda: httpx.AsyncClient(base_url=app_url, transport=transport)
+    clients = []
+    if scenario in ("page", "logout"):
+        # Log the virtual users in up front; that is not what is being measured.
+        async def logged_in(i):
+            client = new_client()
+            await login(client, email_for(i, args))
+            return client
+        count = args.concurrency if scenario == "page" else args.requests
+        clients = await asyncio.gather(*[logged_in(i) for i in range(count)])
+
+    async with httpx.AsyncClient() as control:
+        await control.post(fake_url + "/_reset")
+
+    run_id = uuid.uuid4().hex[:8]
+    latencies = []
+    errors = 0
+    next_request = 0
+
+    async def one(i):
+        if scenario == "login":
+            # Not closed: closing a client closes the shared transport
+            return await login(new_client(), email_for(i, args))
+        if scenario == "page":
+            resp = await clients[i % len(clients)].get("/")
+            return resp.status_code == 200
+        if scenario == "register":
+            resp = await new_client().post("/register", data={
+                "email": f"bench-{run_id}-{i}@example.com",
+                "password": PASSWORD,
+                "firstName": "Bench",
+                "lastName": str(i)})
+            return resp.status_code == 303
+        if scenario == "logout":
+            resp = await clients[i].get("/logout")
+            return resp.status_code in (303, 307)
+
+    async def worker():
+        nonlocal next_request, errors
+        while next_request < args.requests:
+            i = next_request
+            next_request += 1
+            start = time.perf_counter()
+            try:
+                ok = await one(i)
+            except httpx.HTTPError:
+                ok = False
+            latencies.append((time.perf_counter() - start) * 1000)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - started
+
+    async with httpx.AsyncClient() as control:
+        calls = (await control.get(fake_url + "/_stats")).json()
+    await transport.aclose()
+
+    calls.pop("errors", None)
+    latencies.sort()
+    return {
+        "scenario": scenario,
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p95": round(percentile(latencies, 95), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "max": round(latencies[-1], 2),
+        },
+        "upstream_calls_per_request": round(sum(calls.values()) / max(len(latencies), 1), 3),
+        "upstream_calls": calls,
+    }
+
+
+async def run(args):
+    results = []
+    for use_tokens in args.use_tokens:
+        for store in args.stores:
+            with tempfile.TemporaryDirectory() as workdir:
+                async with servers(args, use_tokens, store, workdir) as (app_url, fake_url):
+                    for scenario in args.scenarios:
+                        result = await run_scenario(scenario, app_url, fake_url, args)
+                        result = dict(use_tokens=use_tokens, store=store, **result)
+                        print(
+                            f"tokens={use_tokens!s:5} store={store:10} {scenario:8} "
+                            f"{result['throughput_rps']:8.1f} req/s  "
+                            f"p50 {result['latency_ms']['p50']:7.2f}ms  "
+                            f"p95 {result['latency_ms']['p95']:7.2f}ms  "
+                            f"p99 {result['latency_ms']['p99']:7.2f}ms  "
+                            f"upstream/req {result['upstream_calls_per_request']:.2f}  "
+                            f"errors {result['errors']}",
+                            file=sys.stderr)
+                        results.append(result)
+    return {
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "workers": args.workers,
+            "users": args.users,
+            "fake_latency_ms": args.fake_latency_ms,
+            "fake_jitter_ms": args.fake_jitter_ms,
+            "fake_error_rate": args.fake_error_rate,
+        },
+        "results": results,
+    }
+
+
+def compare(report, baseline, threshold):
+    """Return a list of regressions of `report` against `baseline`: throughput down, p95
+    latency or upstream calls per request up, by more than `threshold` (a fraction)."""
+    key = lambda r: (r["use_tokens"], r["store"], r["scenario"])
+    previous = {key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        name = "tokens={} store={} {}".format(*key(result))
+        if result["throughput_rps"] < old["throughput_rps"] * (1 - threshold):
+            regressions.append(f"{name}: throughput {old['throughput_rps']} -> {result['throughput_rps']} req/s")
+        if result["latency_ms"]["p95"] > old["latency_ms"]["p95"] * (1 + threshold):
+            regressions.append(f"{name}: p95 {old['latency_ms']['p95']} -> {result['latency_ms']['p95']} ms")
+        if result["upstream_calls_per_request"] > old["upstream_calls_per_request"] * (1 + threshold):
+            regressions.append(f"{name}: upstream calls/request {old['upstream_calls_per_request']} -> {result['upstream_calls_per_request']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the app's auth paths against a fake FusionAuth.")
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--users", type=int, default=200, help="seeded users to log in as")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--stores", nargs="+", choices=["filesystem", "sqlite"], default=["filesystem", "sqlite"])
+    parser.add_argument("--use-tokens", nargs="+", choices=["false", "true"], default=["false", "true"])
+    parser.add_argument("--jwt-ttl", type=int, default=300)
+    parser.add_argument("--fake-latency-ms", type=float, default=5.0)
+    parser.add_argument("--fake-jitter-ms", type=float, default=0.0)
+    parser.add_argument("--fake-error-rate", type=float, default=0.0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="previous JSON report to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.1, help="regression tolerance, as a fraction")
+    args = parser.parse_args()
+    args.use_tokens = [v == "true" for v in args.use_tokens]
+
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
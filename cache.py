@@ -0,0 +1,65 @@
+"""
+In-process caching of FusionAuth users.
+
+Each worker process has its own cache. A webhook delivered to one worker only evicts
+from that worker's cache, so the TTL is what bounds staleness everywhere else. Keep it
+short (seconds) -- the point is to collapse the many requests a user makes in a short
+window into one FusionAuth call, not to hold user data for long.
+
+Expired users are kept for another `grace` seconds as the last known good copy, which
+`get_stale` returns. That is only meant for when FusionAuth cannot be reached, so that
+users who are already logged in can carry on through a short outage.
+"""
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    """Bounded TTL + LRU cache of `backends.User` objects keyed by user id."""
+
+    def __init__(self, maxsize=10000, ttl=10.0, grace=0.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.grace = grace
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._data = OrderedDict() # user_id -> (expires_at, user)
+
+    def get(self, user_id):
+        entry = self._data.get(user_id)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None and entry[0] + self.grace <= time.monotonic():
+                del self._data[user_id]
+            self.misses += 1
+            return None
+        self._data.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def get_stale(self, user_id):
+        """Return the user even if expired, as long as it is within the grace period."""
+        entry = self._data.get(user_id)
+        if entry is None or entry[0] + self.grace <= time.monotonic():
+            return None
+        self.stale_hits += 1
+        return entry[1]
+
+    def set(self, user_id, user):
+        self._data[user_id] = (time.monotonic() + self.ttl, user)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def evict(self, user_id):
+        return self._data.pop(user_id, None) is not None
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses,
+            "stale_hits": self.stale_hits}
@@ -0,0 +1,332 @@
+"""
+A local stand-in for FusionAuth, for benchmarking and testing the app without a real
+FusionAuth instance.
+
+Implements just the API calls the app and provision.py make: login, user retrieve (by
+id and by JWT), user search by ids, registration, bulk import, refresh token exchange
+and revocation, and the JWKS endpoint. Access tokens are HS256 JWTs signed with
+`--hmac-secret`; run the app with the same value in FUSIONAUTH_JWT_HMAC_SECRET.
+
+Latency and error rate can be set on the command line, or changed while running by
+POSTing JSON to /_config. GET /_stats returns the number of calls per operation, and
+POST /_reset zeroes them.
+
+    python fake_fusionauth.py --port 9011 --users 100 --latency-ms 20
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import random
+import secrets
+import time
+import uuid
+import jwt
+import uvicorn
+from collections import Counter
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+
+class FakeFusionAuth:
+
+    def __init__(self, *, api_key="fake-api-key", client_id="fake-client-id",
+            client_secret="fake-client-secret", hmac_secret="fake-hmac-secret-for-local-benchmarks",
+            jwt_ttl=300, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0):
+        self.api_key = api_key
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.hmac_secret = hmac_secret
+        self.jwt_ttl = jwt_ttl
+        self.config = {"latency_ms": latency_ms, "jitter_ms": jitter_ms, "error_rate": error_rate}
+        self.users = {} # id -> user
+        self.passwords = {} # id -> password
+        self.emails = {} # email -> id
+        self.refresh_tokens = {} # token -> user id
+        self.calls = Counter()
+
+    ### Fake data
+
+    def add_user(self, email, password, first_name=None, last_name=None, user_id=None,
+            registrations=None):
+        now = int(time.time() * 1000)
+        user_id = user_id or str(uuid.uuid4())
+        user = {
+            "active": True,
+            "id": user_id,
+            "email": email,
+            "firstName": first_name,
+            "lastName": last_name,
+            "insertInstant": now,
+            "lastUpdateInstant": now,
+            "lastLoginInstant": now,
+            "passwordLastUpdateInstant": now,
+            "passwordChangeRequired": False,
+            "registrations": registrations if registrations is not None else [
+                {"applicationId": self.client_id, "roles": [], "insertInstant": now}],
+        }
+        self.users[user_id] = user
+        self.passwords[user_id] = password
+        self.emails[email] = user_id
+        return user
+
+    def seed(self, count, password="password"):
+        for i in range(count):
+            self.add_user(f"user{i}@example.com", password)
+
+    def issue_tokens(self, user):
+        now = int(time.time())
+        registration = next(
+            (r for r in user["registrations"] if r["applicationId"] == self.client_id), None)
+        claims = {
+            "aud": self.client_id,
+            "exp": now + self.jwt_ttl,
+            "iat": now,
+            "iss": "fake-fusionauth",
+            "sub": user["id"],
+            "jti": str(uuid.uuid4()),
+            "email": user["email"],
+            "auth_time": now,
+        }
+        if registration is not None:
+            claims["applicationId"] = self.client_id
+            claims["roles"] = registration.get("roles", [])
+        access_token = jwt.encode(claims, self.hmac_secret, algorithm="HS256")
+        refresh_token = secrets.token_urlsafe(32)
+        self.refresh_tokens[refresh_token] = user["id"]
+        return access_token, refresh_token
+
+    ### Request plumbing
+
+    async def _simulate(self, op):
+        """Count the call, wait out the configured latency and maybe fail."""
+        self.calls[op] += 1
+        latency = self.config["latency_ms"] + random.uniform(0, self.config["jitter_ms"])
+        if latency > 0:
+            await asyncio.sleep(latency / 1000)
+        if self.config["error_rate"] and random.random() < self.config["error_rate"]:
+            self.calls["errors"] += 1
+            return Response(status_code=500)
+        return None
+
+    def _authorized(self, request):
+        return request.headers.get("authorization") == self.api_key
+
+    def _check_password(self, user_id, password):
+        stored = self.passwords[user_id]
+        if isinstance(stored, dict): # imported with a hash; only FusionAuth's default scheme
+            if stored.get("encryptionScheme") != "salted-pbkdf2-hmac-sha256" or password is None:
+                return False
+            digest = hashlib.pbkdf2_hmac(
+                "sha256", password.encode(), base64.b64decode(stored["salt"]), stored["factor"])
+            return hmac.compare_digest(base64.b64encode(digest).decode(), stored["password"])
+        return stored == password
+
+    ### Endpoints
+
+    async def login(self, request):
+        error = await self._simulate("login")
+        if error:
+            return error
+        body = await request.json()
+        user_id = self.emails.get(body.get("loginId"))
+        if user_id is None or not self._check_password(user_id, body.get("password")):
+            return Response(status_code=404)
+        user = self.users[user_id]
+        if not user["active"]:
+            return Response(status_code=423)
+        access_token, refresh_token = self.issue_tokens(user)
+        return JSONResponse({"user": user, "token": access_token, "refreshToken": refresh_token})
+
+    async def retrieve_user(self, request):
+        error = await self._simulate("retrieve_user")
+        if error:
+            return error
+        if not self._authorized(request):
+            return Response(status_code=401)
+        user = self.users.get(request.path_params["user_id"])
+        if user is None:
+            return Response(status_code=404)
+        return JSONResponse({"user": user})
+
+    async def search_users(self, request):
+        # Only the search by ids; unknown ids are left out of the results
+        error = await self._simulate("search_users")
+        if error:
+            return error
+        if not self._authorized(request):
+            return Response(status_code=401)
+        users = [self.users[i] for i in request.query_params.getlist("ids") if i in self.users]
+        return JSONResponse({"total": len(users), "users": users})
+
+    async def retrieve_user_using_jwt(self, request):
+        error = await self._simulate("retrieve_user_using_jwt")
+        if error:
+            return error
+        auth = request.headers.get("authorization", "")
+        if not auth.startswith("Bearer "):
+            return Response(status_code=401)
+        try:
+            claims = jwt.decode(auth[7:], self.hmac_secret, algorithms=["HS256"], audience=self.client_id)
+        except jwt.InvalidTokenError:
+            return Response(status_code=401)
+        user = self.users.get(claims["sub"])
+        if user is None:
+            return Response(status_code=404)
+        return JSONResponse({"user": user})
+
+    async def register(self, request):
+        error = await self._simulate("register")
+        if error:
+            return error
+        if not self._authorized(request):
+            return Response(status_code=401)
+        body = await request.json()
+        user = body.get("user") or {}
+        registration = body.get("registration") or {}
+        if user.get("email") in self.emails:
+            return JSONResponse({"fieldErrors": {"user.email": [
+                {"code": "[duplicate]user.email", "message": "A User with email already exists."}]}},
+                status_code=400)
+        if not user.get("email") or not user.get("password"):
+            return JSONResponse({"fieldErrors": {"user.email": [
+                {"code": "[blank]user.email", "message": "You must specify either the [user.email] or [user.username] property."}]}},
+                status_code=400)
+        registration = dict(registration, roles=registration.get("roles", []))
+        created = self.add_user(
+            user["email"], user["password"], user.get("firstName"), user.get("lastName"),
+            registrations=[registration])
+        return JSONResponse({"user": created, "registration": registration})
+
+    async def import_users(self, request):
+        # All or nothing, like FusionAuth's import with validateDbConstraints
+        error = await self._simulate("import_users")
+        if error:
+            return error
+        if not self._authorized(request):
+            return Response(status_code=401)
+        users = (await request.json()).get("users") or []
+        seen = set()
+        for user in users:
+            email = user.get("email")
+            if not email:
+                return JSONResponse({"fieldErrors": {"user.email": [
+                    {"code": "[blank]user.email", "message": "You must specify the [user.email] property."}]}},
+                    status_code=400)
+            if email in self.emails or email in seen:
+                return JSONResponse({"fieldErrors": {"user.email": [
+                    {"code": "[duplicate]user.email", "message": f"A User with email [{email}] already exists."}]}},
+                    status_code=400)
+            seen.add(email)
+        for user in users:
+            password = None
+            if user.get("password") is not None:
+                password = {k: user.get(k) for k in ("encryptionScheme", "factor", "salt", "password")}
+            self.add_user(
+                user["email"], password, user.get("firstName"), user.get("lastName"),
+                user_id=user.get("id"), registrations=[
+                    dict(r, roles=r.get("roles", [])) for r in user.get("registrations", [])])
+        return Response(status_code=200)
+
+    async def revoke_refresh_token(self, request):
+        error = await self._simulate("revoke_refresh_token")
+        if error:
+            return error
+        if not self._authorized(request):
+            return Response(status_code=401)
+        token = request.query_params.get("token")
+        user_id = request.query_params.get("userId")
+        if token is not None:
+            self.refresh_tokens.pop(token, None)
+        elif user_id is not None:
+            for t in [t for t, uid in self.refresh_tokens.items() if uid == user_id]:
+                del self.refresh_tokens[t]
+        return Response(status_code=200)
+
+    async def token(self, request):
+        error = await self._simulate("token")
+        if error:
+            return error
+        form = await request.form()
+        if form.get("grant_type") != "refresh_token":
+            return JSONResponse({"error": "unsupported_grant_type",
+                "error_description": "Only the refresh_token grant is faked",
+                "error_reason": "unsupported_grant_type"}, status_code=400)
+        # Refresh tokens are rotated: the presented one is spent.
+        user_id = self.refresh_tokens.pop(form.get("refresh_token"), None)
+        if user_id is None or user_id not in self.users:
+            return JSONResponse({"error": "invalid_grant",
+                "error_description": "The refresh token is invalid or expired",
+                "error_reason": "refresh_token_not_found"}, status_code=400)
+        access_token, refresh_token = self.issue_tokens(self.users[user_id])
+        return JSONResponse({"access_token": access_token, "refresh_token": refresh_token,
+            "token_type": "Bearer", "expires_in": self.jwt_ttl, "userId": user_id})
+
+    async def jwks(self, request):
+        error = await self._simulate("jwks")
+        if error:
+            return error
+        return JSONResponse({"keys": []}) # access tokens are HMAC signed
+
+    ### Control endpoints, not part of FusionAuth
+
+    async def stats(self, request):
+        return JSONResponse(dict(self.calls))
+
+    async def reset(self, request):
+        self.calls.clear()
+        return JSONResponse({})
+
+    async def set_config(self, request):
+        self.config.update(await request.json())
+        return JSONResponse(self.config)
+
+    def app(self):
+        return Starlette(routes=[
+            Route("/api/login", self.login, methods=["POST"]),
+            Route("/api/user", self.retrieve_user_using_jwt),
+            Route("/api/user/registration", self.register, methods=["POST"]),
+            Route("/api/user/search", self.search_users),
+            Route("/api/user/import", self.import_users, methods=["POST"]),
+            Route("/api/user/{user_id}", self.retrieve_user),
+            Route("/api/jwt/refresh", self.revoke_refresh_token, methods=["DELETE"]),
+            Route("/oauth2/token", self.token, methods=["POST"]),
+            Route("/.well-known/jwks.json", self.jwks),
+            Route("/_stats", self.stats),
+            Route("/_reset", self.reset, methods=["POST"]),
+            Route("/_config", self.set_config, methods=["POST"]),
+        ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake FusionAuth server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9011)
+    parser.add_argument("--api-key", default="fake-api-key")
+    parser.add_argument("--client-id", default="fake-client-id")
+    parser.add_argument("--client-secret", default="fake-client-secret")
+    parser.add_argument("--hmac-secret", default="fake-hmac-secret-for-local-benchmarks")
+    parser.add_argument("--jwt-ttl", type=int, default=300, help="access token lifetime, seconds")
+    parser.add_argument("--users", type=int, default=100, help="seed user{i}@example.com / password")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls failing with a 500")
+    args = parser.parse_args()
+
+    fake = FakeFusionAuth(
+        api_key=args.api_key,
+        client_id=args.client_id,
+        client_secret=args.client_secret,
+        hmac_secret=args.hmac_secret,
+        jwt_ttl=args.jwt_ttl,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate)
+    fake.seed(args.users)
+    uvicorn.run(fake.app(), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Async FusionAuth client.
+
+The official fusionauth-client is built on blocking `requests` calls, so calling it from
+an `async def` endpoint stalls the whole event loop for the duration of the round trip.
+This is a small async replacement covering only the API calls this app makes. All calls
+share one keep-alive connection pool.
+
+Responses mirror the official client's `ClientResponse` (`status`, `success_response`,
+`error_response`, `was_successful()`) so the calling code reads the same as the
+examples in the FusionAuth docs. Unlike the official client, server errors (5xx),
+timeouts and connection errors raise resilience.UpstreamUnavailable, as do calls turned
+away by the optional bulkhead and circuit breaker.
+"""
+import contextlib
+import httpx
+import metrics
+import tracing
+from resilience import UpstreamUnavailable
+
+
+class ClientResponse:
+    """Mirrors fusionauth.rest_client.ClientResponse for an httpx response."""
+
+    def __init__(self, response):
+        self.error_response = None
+        self.exception = None
+        self.response = response
+        self.success_response = None
+        self.status = response.status_code
+
+        if self.status < 200 or self.status > 299:
+            if self.response.content and self.status != 404:
+                if self.status == 400:
+                    self.error_response = self.response.json()
+                else:
+                    self.error_response = self.response
+        else:
+            try:
+                self.success_response = self.response.json()
+            except ValueError:
+                self.success_response = None
+
+    def was_successful(self):
+        return 200 <= self.status <= 299 and self.exception is None
+
+
+class AsyncFusionAuthClient:
+
+    def __init__(self, api_key, base_url, *, timeout=5.0, connect_timeout=2.0, pool_size=20,
+            timeouts=None, bulkhead=None, breaker=None):
+        """`timeout` applies to each of read/write/pool acquisition, `connect_timeout` to
+        establishing a new connection. `timeouts` overrides `timeout` per operation, as
+        {operation: seconds}. `pool_size` caps the number of concurrent connections to
+        FusionAuth; idle connections are kept alive for reuse.
+
+        `bulkhead` and `breaker` are a resilience.Bulkhead and CircuitBreaker shared by
+        all calls.
+        """
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeouts = {
+            operation: httpx.Timeout(seconds, connect=min(seconds, connect_timeout))
+            for operation, seconds in (timeouts or {}).items()}
+        self.bulkhead = bulkhead
+        self.breaker = breaker
+        self._http = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    async def aclose(self):
+        await self._http.aclose()
+
+    async def _request(self, operation, method, uri, *, authorization=None, anonymous=False, **kwargs):
+        """`operation` names the call in metrics and `timeouts`."""
+        headers = kwargs.pop("headers", {})
+        if authorization is not None:
+            headers["Authorization"] = authorization
+        elif not anonymous:
+            headers["Authorization"] = self.api_key
+        timeout = self.timeouts.get(operation, httpx.USE_CLIENT_DEFAULT)
+        try:
+            async with self._slot(operation):
+                self._before_call(operation)
+                try:
+                    with metrics.track_upstream(operation), tracing.span(f"fusionauth.{operation}"):
+                        resp = await self._http.request(method, uri, headers=headers, timeout=timeout, **kwargs)
+                except httpx.TimeoutException as e:
+                    self._record(True)
+                    raise UpstreamUnavailable(operation, "timeout", repr(e)) from e
+                except httpx.TransportError as e:
+                    self._record(True)
+                    raise UpstreamUnavailable(operation, "error", repr(e)) from e
+                except BaseException: # e.g. cancelled because the client went away
+                    if self.breaker is not None:
+                        self.breaker.release()
+                    raise
+                self._record(resp.status_code >= 500)
+        except UpstreamUnavailable as e:
+            if e.reason in ("bulkhead_full", "circuit_open"):
+                metrics.UPSTREAM_REJECTED.labels(operation, e.reason).inc()
+            raise
+        if resp.status_code >= 500:
+            raise UpstreamUnavailable(operation, "server_error", resp.status_code)
+        return ClientResponse(resp)
+
+    def _slot(self, operation):
+        if self.bulkhead is None:
+            return contextlib.nullcontext()
+        return self.bulkhead.slot(operation)
+
+    def _before_call(self, operation):
+        if self.breaker is not None:
+            self.breaker.before_call(operation)
+
+    def _record(self, failed):
+        if self.breaker is not None:
+            self.breaker.record(failed)
+
+    @staticmethod
+    def _form(body):
+        return {k: v for k, v in body.items() if v is not None}
+
+    async def login(self, request):
+        return await self._request("login", "POST", "/api/login", json=request)
+
+    async def register(self, request, user_id=None):
+        uri = "/api/user/registration"
+        if user_id is not None:
+            uri = f"{uri}/{user_id}"
+        return await self._request("register", "POST", uri, json=request)
+
+    async def import_users(self, request):
+        return await self._request("import_users", "POST", "/api/user/import", json=request)
+
+    async def retrieve_user(self, user_id):
+        return await self._request("retrieve_user", "GET", f"/api/user/{user_id}")
+
+    async def search_users_by_ids(self, user_ids):
+        return await self._request("search_users", "GET", "/api/user/search", params={"ids": list(user_ids)})
+
+    async def retrieve_user_using_jwt(self, encoded_jwt):
+        return await self._request("retrieve_user_using_jwt", "GET", "/api/user", authorization=f"Bearer {encoded_jwt}")
+
+    async def retrieve_json_web_key_set(self):
+        return await self._request("jwks", "GET", "/.well-known/jwks.json", anonymous=True)
+
+    async def revoke_refresh_token(self, token=None, user_id=None, application_id=None):
+        params = {"token": token, "userId": user_id, "applicationId": application_id}
+        return await self._request("revoke", "DELETE", "/api/jwt/refresh", params=self._form(params))
+
+    async def exchange_o_auth_code_for_access_token_using_pkce(self, code, redirect_uri,
+            code_verifier, client_id=None, client_secret=None):
+        body = {
+            "code": code,
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "grant_type": "authorization_code",
+            "redirect_uri": redirect_uri,
+            "code_verifier": code_verifier,
+        }
+        return await self._request("exchange_code", "POST", "/oauth2/token", anonymous=True, data=self._form(body))
+
+    async def exchange_refresh_token_for_access_token(self, refresh_token, client_id=None,
+            client_secret=None, scope=None, user_code=None):
+        body = {
+            "refresh_token": refresh_token,
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "grant_type": "refresh_token",
+            "scope": scope,
+            "user_code": user_code,
+        }
+        return await self._request("refresh", "POST", "/oauth2/token", anonymous=True, data=self._form(body))
@@ -1,17 +1,23 @@
+import asyncio
+import contextlib
+import hmac
 import os
 import urllib
+import jinja2
 import pkce
-from fusionauth.fusionauth_client import FusionAuthClient
 from starlette.applications import Starlette
-from starlette.middleware.authentication import AuthenticationMiddleware
 from starlette.responses import PlainTextResponse, RedirectResponse
 from starlette.routing import Route, Mount
 from starlette.templating import Jinja2Templates
-from starlette.staticfiles import StaticFiles
 from starsessions import load_session, SessionMiddleware
 from starsessions.session import regenerate_session_id
-from store import FilesystemStore
+from assets import StaticAssets
+from pagecache import PageCache
+from resilience import UpstreamUnavailable
+from store import FilesystemStore, SERIALIZERS, SQLiteStore, ThrottledStore
 import backends
+import metrics
+import tracing
 
 
 """
@@ -45,16 +51,48 @@ SECRET_KEY = os.environ.get("SECRET_KEY", "supersecret__changeme")
 SESSION_COOKIE = os.environ.get("SESSION_COOKIE", "fa.example.starlette")
 SESSION_EXPIRE_SECONDS = int(os.environ.get("SESSION_EXPIRE_SECONDS", 60*60*24*10))
 SESSION_SAME_SITE = os.environ.get("SESSION_SAME_SITE", "lax") # lax, strict, or none
+SESSION_STORE = os.environ.get("SESSION_STORE", "filesystem") # filesystem, or sqlite for multiple workers
+SESSION_DIR = os.environ.get("SESSION_DIR", ".sessions") # directory for the filesystem store
+SESSION_DB = os.environ.get("SESSION_DB", "sessions.db") # database file for the sqlite store
+SESSION_SERIALIZER = os.environ.get("SESSION_SERIALIZER", "compact") # compact (msgpack), or json
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0)) # fraction of requests to trace, 0 to disable
+TRACE_LOG = os.environ.get("TRACE_LOG", "false").lower() == "true" # also log traced requests' spans
+TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR", ".templates_cache") # compiled templates, shared by workers
+# Pick up edited templates without a restart. For development; in production templates
+# are checked once, at startup.
+TEMPLATE_RELOAD = os.environ.get("TEMPLATE_RELOAD", "false").lower() == "true"
+SESSION_ROLLING = os.environ.get("SESSION_ROLLING", "false").lower() == "true"
+# Unchanged sessions are only rewritten to push out a rolling expiry, at most this often.
+SESSION_REFRESH_INTERVAL = int(os.environ.get("SESSION_REFRESH_INTERVAL", 300))
 
 API_KEY = os.environ["FUSIONAUTH_API_KEY"]
 CLIENT_ID = os.environ["FUSIONAUTH_CLIENT_ID"]
 CLIENT_SECRET = os.environ["FUSIONAUTH_CLIENT_SECRET"]
 FUSIONAUTH_HOST_IP = os.environ.get("FUSIONAUTH_HOST_IP", "localhost")
 FUSIONAUTH_HOST_PORT = os.environ.get("FUSIONAUTH_HOST_PORT", "9011")
-
-
-client = FusionAuthClient(API_KEY, f"http://{FUSIONAUTH_HOST_IP}:{FUSIONAUTH_HOST_PORT}")
-templates = Jinja2Templates(directory='templates')
+# Configure the webhook in FusionAuth to send this value in the Authorization header
+# (Webhook > Security > Basic auth, or a custom header). Unset disables the webhook.
+FUSIONAUTH_WEBHOOK_SECRET = os.environ.get("FUSIONAUTH_WEBHOOK_SECRET")
+
+
+client = backends.client
+# Fingerprinted and precompressed at startup. Link to files with {{ asset('main.css') }}
+assets = StaticAssets('static', prefix='/static')
+os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+template_env = jinja2.Environment(
+    loader=jinja2.FileSystemLoader('templates'),
+    autoescape=True,
+    auto_reload=TEMPLATE_RELOAD,
+    bytecode_cache=jinja2.FileSystemBytecodeCache(TEMPLATE_CACHE_DIR))
+template_env.globals["asset"] = assets.url
+try:
+    templates = Jinja2Templates(env=template_env)
+except TypeError: # Starlette < 0.28 builds its own environment; swap ours in
+    templates = Jinja2Templates(directory='templates')
+    template_env.globals["url_for"] = templates.env.globals["url_for"]
+    templates.env = template_env
+# Anonymous renders of the pages that look the same to every visitor
+pages = PageCache(templates, 'templates', check_interval=1.0 if TEMPLATE_RELOAD else None)
 
 """
 If using OAuth:
@@ -93,17 +131,34 @@ def fusionauth_logout_url():
     return f"http://{FUSIONAUTH_HOST_IP}:{FUSIONAUTH_HOST_PORT}/oauth2/logout?client_id={CLIENT_ID}&post_logout_redirect_uri={redir}"
 
 
-def render(template, context=None):
+def render(template, context=None, status_code=200):
     if context is None:
         context = {}
-    return templates.TemplateResponse(template, context)
+    with tracing.span("render"):
+        return templates.TemplateResponse(template, context, status_code=status_code)
 
 
+async def upstream_unavailable(request, exc):
+    """FusionAuth is down, slow or being shed by the circuit breaker. Answer right away
+    rather than holding the request.
+    """
+    response = render(
+        "error.html", dict(
+        request=request,
+        msg="Authentication is temporarily unavailable. Please try again shortly.",
+        reason=exc.reason,
+        description="The authentication service could not be reached."),
+        status_code=503)
+    response.headers["Retry-After"] = str(int(backends.CIRCUIT_RESET_TIMEOUT))
+    return response
+
+
+@backends.with_user
 async def homepage(request):
-    if USE_OAUTH:
-        return render('index-oauth.html', {'request': request})
-    else:
-        return render('index-loginform.html', {'request': request})
+    template = 'index-oauth.html' if USE_OAUTH else 'index-loginform.html'
+    if not request.user.is_authenticated:
+        return pages.response(request, template)
+    return render(template, {'request': request})
 
 
 async def register(request):
@@ -137,6 +192,8 @@ async def register(request):
         request.session["code_verifier"] = code_verifier
         return RedirectResponse(fusionauth_register_url(code_challenge))
     else:
+        if request.method == "GET":
+            return pages.response(request, "register.html")
         errors = None
         if request.method == "POST":
             form = await request.form()
@@ -152,7 +209,7 @@ async def register(request):
                 }
             }
             # https://github.com/FusionAuth/fusionauth-python-client/blob/master/src/main/python/fusionauth/fusionauth_client.py#L1975
-            register_resp = client.register(data)
+            register_resp = await client.register(data)
             if register_resp.was_successful():
                 return RedirectResponse(url=request.url_for("homepage"), status_code=303)
             # TODO: better error handling
@@ -172,7 +229,7 @@ async def login(request):
 async def login_form(request):
     # https://fusionauth.io/docs/v1/tech/apis/login#authenticate-a-user
     data = await request.form()
-    resp = client.login({
+    resp = await client.login({
       "loginId": data["email"],
       "password": data["password"],
       "applicationId": CLIENT_ID,
@@ -180,9 +237,17 @@ async def login_form(request):
       #"ipAddress": "192.168.1.42"
     })
     if not resp.status == 200:
-        raise Exception # TODO: handle cases
+        # 404: unknown login id or wrong password. The other statuses (locked, expired
+        # or unverified accounts, ...) are described in the docs linked above.
+        return render(
+            "error.html", dict(
+            request=request,
+            msg="Invalid email or password." if resp.status == 404 else "Login failed.",
+            reason=f"FusionAuth login status {resp.status}",
+            description="See https://fusionauth.io/docs/v1/tech/apis/login#response"),
+            status_code=401 if resp.status == 404 else 403)
     data = resp.success_response
-    regenerate_session_id(request)
+    session_id = regenerate_session_id(request)
     await load_session(request)
     request.session.clear()
     registrations = data["user"]["registrations"]
@@ -201,10 +266,23 @@ async def login_form(request):
         request.session["refresh_token"] = data["refreshToken"]
     else:
         request.session["user_id"] = data["user"]["id"]
+    if session_store.supports_user_index:
+        await session_store.index_user(session_id, data["user"]["id"])
     return RedirectResponse(url="/", status_code=303)
 
 
 
+async def revoke_refresh_token(token=None, **kwargs):
+    """Revoke refresh tokens as part of a logout. If FusionAuth is unavailable the
+    logout still goes ahead: the session is cleared regardless, and the refresh token
+    expires on its own.
+    """
+    try:
+        return await client.revoke_refresh_token(token, **kwargs)
+    except UpstreamUnavailable:
+        return None
+
+
 async def logout(request):
     if USE_OAUTH:
         #revoke_resp = client.revoke_refresh_tokens_by_application_id(CLIENT_ID)
@@ -219,8 +297,9 @@ async def logout(request):
         # tries to download an empty file called single-logout.
         # See: https://fusionauth.io/community/forum/topic/2209/logout-triggers-a-file-download-in-firefox?_=1666224554722
         await load_session(request)
-        if USE_TOKENS:
-            revoke_resp = client.revoke_refresh_token(request.session["refresh_token"])
+        if USE_TOKENS and "refresh_token" in request.session:
+            await revoke_refresh_token(request.session["refresh_token"])
+            await backends.revoke_access_token(request.session["access_token"])
         request.session.clear() # delete the tokens if used, otherwise deletes the user_id
         return RedirectResponse(url=fusionauth_logout_url())
     else:
@@ -232,19 +311,41 @@ async def logout(request):
         # access token revocation. Wrt the refresh token, this is almost certainly a bug.
         #
         # Thus, we call revoke_refresh_token directly.
-        if USE_TOKENS:
-            revoke_resp = client.revoke_refresh_token(request.session["refresh_token"])
+        if USE_TOKENS and "refresh_token" in request.session:
+            await revoke_refresh_token(request.session["refresh_token"])
+            # By design, FusionAuth does not provide a mechanism for revoking access
+            # tokens, so the app keeps its own denylist (see revocation.py). Note the
+            # access token, if leaked, is still accepted by anything else that verifies
+            # it until it times out.
+            await backends.revoke_access_token(request.session["access_token"])
         request.session.clear() # delete the tokens or the user_id
-        # Note the access token, if leaked, will still be valid at this point until it
-        # times out. By design, FusionAuth does not provide a mechanism for revoking access tokens.
         return RedirectResponse("/")
 
 
+async def logout_everywhere(request):
+    """Ends all of the current user's sessions, on every device. Needs a session store
+    that indexes sessions by user (SESSION_STORE=sqlite) or USE_TOKENS; otherwise this is
+    a plain logout.
+    """
+    await load_session(request)
+    user = await backends.resolve_user(request)
+    if user.is_authenticated and USE_TOKENS:
+        # Sessions elsewhere hold tokens that are revoked here, whatever the session store
+        await revoke_refresh_token(user_id=user.user_id, application_id=CLIENT_ID)
+        await backends.revocations.revoke_user(user.user_id)
+    elif USE_TOKENS and "refresh_token" in request.session:
+        await revoke_refresh_token(request.session["refresh_token"])
+    if user.is_authenticated and session_store.supports_user_index:
+        await session_store.revoke_user(user.user_id)
+    request.session.clear()
+    return RedirectResponse("/")
+
+
 async def oauth_callback(request):
     """This callback is only needed for USE_OAUTH=True. See caveats in notes for that
     setting above.
     """
-    regenerate_session_id(request)
+    session_id = regenerate_session_id(request)
     await load_session(request)
     if "access_token" in request.session:
         del request.session["access_token"]
@@ -259,7 +360,7 @@ async def oauth_callback(request):
             description=request.query_params["error_description"])
         )
     uri = "http://localhost:8000%s" % app.url_path_for("oauth_callback")
-    tok_resp = client.exchange_o_auth_code_for_access_token_using_pkce(
+    tok_resp = await client.exchange_o_auth_code_for_access_token_using_pkce(
         request.query_params.get("code"),
         uri,
         request.session['code_verifier'],
@@ -280,7 +381,7 @@ async def oauth_callback(request):
         assert refresh_token is not None, 'To receive a refresh token, be sure to enable ' \
             '"Generate Refresh Tokens" for the app, and specify `scope=offline_access` in '\
             'the request to the authorize endpoint.'
-    user_resp = client.retrieve_user_using_jwt(access_token)
+    user_resp = await client.retrieve_user_using_jwt(access_token)
     if not user_resp.was_successful():
         return render(
             "error.html", dict(
@@ -303,33 +404,132 @@ async def oauth_callback(request):
         request.session["refresh_token"] = refresh_token
     else:
         request.session["user_id"] = user_resp.success_response["user"]["id"] 
+    if session_store.supports_user_index:
+        await session_store.index_user(session_id, user_resp.success_response["user"]["id"])
     return RedirectResponse(url="/")
 
 
+# Events after which a cached user record can no longer be trusted.
+USER_CACHE_EVICTING_EVENTS = {"user.update", "user.delete", "user.deactivate", "user.reactivate"}
+# Events after which none of the user's sessions should remain usable.
+SESSION_REVOKING_EVENTS = {"user.delete", "user.deactivate", "user.registration.delete"}
+
+
+async def fusionauth_webhook(request):
+    """Receives FusionAuth webhook events and evicts affected users from the user cache.
+    Deleted and deactivated users, and users whose registration for this application
+    is deleted, also have their access tokens revoked (USE_TOKENS), and with a session
+    store that indexes sessions by user, all of their sessions.
+
+    Enable the events of interest (user.update, user.delete, user.deactivate and the
+    user.registration.* events) on a webhook pointed at this URL, and enable the webhook
+    for the tenant. Requests must carry FUSIONAUTH_WEBHOOK_SECRET in the Authorization
+    header; without that setting the endpoint refuses all of them. Note that only the
+    worker process that receives the event evicts the user; other workers pick up the
+    change once the cached entry expires (backends.USER_CACHE_TTL).
+    """
+    if FUSIONAUTH_WEBHOOK_SECRET is None:
+        # Events log users out, so anonymous callers must not be able to send them
+        return PlainTextResponse("Forbidden: FUSIONAUTH_WEBHOOK_SECRET is not set", status_code=403)
+    if not hmac.compare_digest(
+            request.headers.get("authorization", "").encode(),
+            FUSIONAUTH_WEBHOOK_SECRET.encode()):
+        return PlainTextResponse("Unauthorized", status_code=401)
+    try:
+        event = (await request.json())["event"]
+        event_type = event["type"]
+        user = event.get("user") or {}
+        user_id = user.get("id")
+        # Registration events name the application they are about
+        registration = event.get("registration") or {}
+        application_id = event.get("applicationId") or registration.get("applicationId")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return PlainTextResponse("Bad Request", status_code=400)
+    if not isinstance(event_type, str) or not isinstance(user_id, (str, type(None))):
+        return PlainTextResponse("Bad Request", status_code=400)
+    if not user_id:
+        return PlainTextResponse("OK")
+    if event_type in USER_CACHE_EVICTING_EVENTS or event_type.startswith("user.registration."):
+        backends.user_cache.evict(user_id)
+    revoke = event_type in SESSION_REVOKING_EVENTS
+    if event_type.startswith("user.registration."):
+        # Sent for every application in the tenant; other apps' registrations do not
+        # affect sessions here
+        revoke = revoke and application_id == CLIENT_ID
+    if revoke:
+        if USE_TOKENS:
+            # FusionAuth issues no new tokens to these users, so no need to spare a
+            # re-login in the same second
+            await backends.revocations.revoke_user(user_id, include_current_second=True)
+        if session_store.supports_user_index:
+            await session_store.revoke_user(user_id)
+    return PlainTextResponse("OK")
+
+
 routes = [
     Route('/', endpoint=homepage),
     Route('/register', endpoint=register, methods=["GET", "POST"]),
     Route('/login', endpoint=login),
     Route('/login-form', endpoint=login_form, methods=["GET", "POST"]),
     Route('/logout', endpoint=logout),
+    Route('/logout-everywhere', endpoint=logout_everywhere),
     Route('/oauth-callback', endpoint=oauth_callback),
-    Mount('/static', StaticFiles(directory='static'), name='static')
+    Route('/webhooks/fusionauth', endpoint=fusionauth_webhook, methods=["POST"]),
+    Route('/metrics', endpoint=metrics.metrics), # Prometheus. Do not expose publicly in production
+    Mount('/static', app=assets, name='static')
 ]
 
 
-app = Starlette(debug=True, routes=routes)
-app.add_middleware(AuthenticationMiddleware, backend=backends.SessionAuthBackend())
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Compile every template now (or load it from the bytecode cache) rather than on
+    # the first request that needs it
+    for name in templates.env.list_templates():
+        templates.env.get_template(name)
+    tasks = [asyncio.create_task(session_store.run_sweeper())]
+    if USE_TOKENS:
+        tasks.append(asyncio.create_task(backends.revocations.run_sync()))
+    yield
+    for task in tasks:
+        task.cancel()
+    await client.aclose()
+    metrics.mark_process_dead()
+
+
+app = Starlette(debug=True, routes=routes, lifespan=lifespan, exception_handlers={
+    UpstreamUnavailable: upstream_unavailable,
+})
+# Authentication happens per request only for endpoints that look at the user (see
+# backends.with_user), and never for static files, FusionAuth webhooks or metrics.
+app.add_middleware(
+    backends.LazyAuthenticationMiddleware,
+    backend=backends.SessionAuthBackend(),
+    public_paths=["/static/", "/webhooks/", "/metrics"])
 
 
-session_store = FilesystemStore() # Should probably not use the fs store in production
+if SESSION_STORE == "sqlite":
+    backing_store = SQLiteStore(
+        SESSION_DB,
+        default_ttl=60 * 60 * 24, # for browser-session cookies, which carry no expiry of their own
+    )
+else:
+    backing_store = FilesystemStore(
+        SESSION_DIR,
+        default_ttl=60 * 60 * 24,
+    ) # Should probably not use the fs store in production
+session_store = ThrottledStore(backing_store, refresh_interval=SESSION_REFRESH_INTERVAL)
 
 app.add_middleware(
     SessionMiddleware,
     store=session_store,
+    serializer=SERIALIZERS[SESSION_SERIALIZER](),
     cookie_https_only=False, # False for development only
     lifetime=3600 * 24 * 14, # Default is the browser session rather than a time period,
                              # although this only works when closing out the browser
                              # entirely, not just closing tabs.
                              # There is also a [rolling sessions](https://github.com/alex-oleshkevich/starsessions#rolling-sessions) option
+    rolling=SESSION_ROLLING,
 )
 
+# Outermost, so that traces include the session write done by SessionMiddleware.
+app.add_middleware(tracing.TracingMiddleware, sample_rate=TRACE_SAMPLE_RATE, log=TRACE_LOG)
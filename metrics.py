@@ -0,0 +1,105 @@
+"""
+Prometheus metrics for FusionAuth calls, the session store and the auth backend.
+
+Served in the Prometheus text format at /metrics. With several uvicorn workers, set
+PROMETHEUS_MULTIPROC_DIR to an empty directory before starting uvicorn. Each worker
+then records its metrics in files there and /metrics aggregates all of them,
+whichever worker answers. See
+https://prometheus.github.io/client_python/multiprocess/
+"""
+import contextlib
+import functools
+import os
+import time
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter,
+    Gauge, Histogram, generate_latest, multiprocess)
+from starlette.responses import Response
+
+
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+# Upstream calls are network round trips; the session store is mostly local I/O.
+UPSTREAM_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1, 2.5, 5, 10)
+STORE_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1)
+
+UPSTREAM_LATENCY = Histogram(
+    "fusionauth_request_duration_seconds",
+    "Latency of FusionAuth API calls.",
+    ["operation"],
+    buckets=UPSTREAM_BUCKETS)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "fusionauth_requests_in_flight",
+    "FusionAuth API calls currently waiting on a response.",
+    ["operation"],
+    multiprocess_mode="livesum")
+UPSTREAM_ERRORS = Counter(
+    "fusionauth_request_errors_total",
+    "FusionAuth API calls that failed without a response (timeouts, connection errors).",
+    ["operation"])
+UPSTREAM_REJECTED = Counter(
+    "fusionauth_requests_rejected_total",
+    "FusionAuth API calls not made because the circuit breaker was open or the bulkhead was full.",
+    ["operation", "reason"])
+USER_BATCH_SIZE = Histogram(
+    "fusionauth_user_batch_size",
+    "Number of users looked up per batched FusionAuth user search.",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+STORE_LATENCY = Histogram(
+    "session_store_duration_seconds",
+    "Latency of session store operations.",
+    ["store", "operation"],
+    buckets=STORE_BUCKETS)
+SESSION_WRITES = Counter(
+    "session_writes_total",
+    "Session saves requested by the session middleware, by whether they were written or skipped as unchanged.",
+    ["result"])
+AUTH_OUTCOMES = Counter(
+    "auth_outcomes_total",
+    "Outcomes of SessionAuthBackend.authenticate: authenticated, unregistered, deactivated, revoked, "
+    "anonymous, refresh_succeeded, refresh_failed and degraded (the last three in addition to the "
+    "final outcome).",
+    ["outcome"])
+
+
+@contextlib.contextmanager
+def track_upstream(operation):
+    in_flight = UPSTREAM_IN_FLIGHT.labels(operation)
+    in_flight.inc()
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        UPSTREAM_ERRORS.labels(operation).inc()
+        raise
+    finally:
+        UPSTREAM_LATENCY.labels(operation).observe(time.perf_counter() - start)
+        in_flight.dec()
+
+
+def timed_store_operation(operation):
+    """Decorator for the async methods of a session store."""
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await method(self, *args, **kwargs)
+            finally:
+                STORE_LATENCY.labels(type(self).__name__, operation).observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def mark_process_dead():
+    """Drop this worker's live gauges from the aggregate. Call on shutdown."""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+async def metrics(request):
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,88 @@
+"""
+Cached rendering of pages that are the same for every anonymous visitor.
+
+The anonymous homepage and the registration form do not depend on who is asking, so
+each is rendered once and the bytes are reused. Responses carry an ETag, and a request
+whose If-None-Match matches gets an empty 304. They are sent with `no-cache`: the
+browser revalidates every time, because the same URL shows something else once the
+visitor logs in.
+
+With a `check_interval`, the cache is dropped whenever a template file changes, checked
+at most that often. Without one, templates are assumed not to change while the app
+runs, and the template directory is only scanned at startup. Rendered pages embed
+absolute URLs (url_for), so entries are also keyed by the request's base URL.
+"""
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from starlette.responses import HTMLResponse, Response
+import tracing
+
+
+class PageCache:
+
+    def __init__(self, templates, directory, check_interval=None, maxsize=64):
+        """`templates` is the Jinja2Templates instance rendering from `directory`.
+        `maxsize` bounds the number of cached pages; the Host header is client supplied.
+        """
+        self.templates = templates
+        self.directory = directory
+        self.check_interval = check_interval
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._pages = OrderedDict() # (template, base url) -> (body, etag)
+        self._version = self._scan()
+        self._checked_at = time.monotonic()
+
+    def _scan(self):
+        """Modification times of all template files, to notice changes."""
+        mtimes = []
+        for root, _, files in os.walk(self.directory):
+            for filename in files:
+                mtimes.append((filename, os.stat(os.path.join(root, filename)).st_mtime_ns))
+        return sorted(mtimes)
+
+    def _check(self):
+        if self.check_interval is None:
+            return
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        version = self._scan()
+        if version != self._version:
+            self._version = version
+            self._pages.clear()
+
+    def _get(self, request, template):
+        self._check()
+        key = (template, str(request.base_url))
+        page = self._pages.get(key)
+        if page is not None:
+            self.hits += 1
+            self._pages.move_to_end(key)
+            return page
+        self.misses += 1
+        with tracing.span("render"):
+            body = self.templates.get_template(template).render({"request": request}).encode("utf-8")
+        page = (body, '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest())
+        self._pages[key] = page
+        if len(self._pages) > self.maxsize:
+            self._pages.popitem(last=False)
+        return page
+
+    def response(self, request, template):
+        """The response for `template` rendered with nothing but the request."""
+        body, etag = self._get(request, template)
+        headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Cookie"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if etag in tags or "*" in tags:
+                return Response(status_code=304, headers=headers)
+        return HTMLResponse(body, headers=headers)
+
+    def stats(self):
+        return {"size": len(self._pages), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,316 @@
+"""
+Bulk user provisioning from CSV or JSON Lines, through FusionAuth's user import API.
+
+Rows are streamed from the input file, validated, and sent to FusionAuth in batches
+(POST /api/user/import) with a few batches in flight at once. Every user is registered
+for the application (FUSIONAUTH_CLIENT_ID, or --application-id). Columns (CSV) or keys
+(JSON Lines):
+
+    email (required), password, firstName, lastName, username, roles
+
+`roles` is a list in JSON Lines and space separated in CSV. The import API takes
+password hashes rather than passwords, so passwords are hashed here with FusionAuth's
+default scheme (salted PBKDF2-HMAC-SHA256). Rows that already carry a hash can give
+`encryptionScheme`, `factor` and `salt` along with it in `password`. Users without a
+password have to go through a password reset before they can log in.
+
+An import request is all or nothing. A batch that FusionAuth rejects is split in
+halves until the offending rows are found, and those rows are appended to the
+failures file (JSON Lines, with the row number and error). Progress is saved to a
+checkpoint file after every batch; running the same command again resumes where the
+last run stopped. A batch that fails for any other reason (FusionAuth unreachable
+after retries, a bad API key) stops the run.
+
+    python provision.py users.csv --batch-size 500 --concurrency 4
+"""
+import argparse
+import asyncio
+import base64
+import csv
+import hashlib
+import json
+import os
+import re
+import secrets
+import sys
+import time
+from fusion import AsyncFusionAuthClient
+from resilience import UpstreamUnavailable
+
+
+EMAIL = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+ENCRYPTION_SCHEME = "salted-pbkdf2-hmac-sha256"
+PBKDF2_FACTOR = 24000 # FusionAuth's default for the scheme
+
+
+class ImportAborted(Exception):
+    pass
+
+
+def read_rows(path, fmt):
+    """Yield (row number, row) from the input file, one at a time. Row numbers count
+    from 1, not including the CSV header. A JSON Lines row that does not parse is None.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if fmt == "csv":
+            yield from enumerate(csv.DictReader(f), 1)
+            return
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield number, row
+
+
+def to_user(row, application_id):
+    """Return the import API user for a row. Raises ValueError saying what is wrong
+    with the row otherwise.
+    """
+    if not isinstance(row, dict):
+        raise ValueError("not a JSON object")
+    email = row.get("email")
+    if not isinstance(email, str) or not EMAIL.match(email.strip()):
+        raise ValueError(f"invalid email: {email!r}")
+    roles = row.get("roles") or []
+    if isinstance(roles, str):
+        roles = roles.split()
+    if not isinstance(roles, list) or not all(isinstance(role, str) for role in roles):
+        raise ValueError("roles must be a list of strings")
+    registration = {"applicationId": application_id, "roles": roles}
+    if row.get("username"):
+        registration["username"] = str(row["username"])
+    user = {"email": email.strip(), "registrations": [registration]}
+    for key in ("firstName", "lastName"):
+        if row.get(key):
+            user[key] = str(row[key])
+    password = row.get("password")
+    if password:
+        if not isinstance(password, str):
+            raise ValueError("password must be a string")
+        if row.get("encryptionScheme"):
+            if not row.get("salt") or not row.get("factor"):
+                raise ValueError("a password hash needs salt and factor")
+            user.update(
+                encryptionScheme=row["encryptionScheme"],
+                factor=int(row["factor"]),
+                salt=row["salt"],
+                password=password)
+        else:
+            user["password"] = password # hashed by hash_passwords before sending
+    return user
+
+
+def hash_passwords(users):
+    """Replace plain passwords with FusionAuth's default password hash, in place.
+    Deliberately slow (PBKDF2); run it off the event loop.
+    """
+    for user in users:
+        if "password" in user and "encryptionScheme" not in user:
+            salt = secrets.token_bytes(32)
+            digest = hashlib.pbkdf2_hmac("sha256", user["password"].encode("utf-8"), salt, PBKDF2_FACTOR)
+            user.update(
+                encryptionScheme=ENCRYPTION_SCHEME,
+                factor=PBKDF2_FACTOR,
+                salt=base64.b64encode(salt).decode("ascii"),
+                password=base64.b64encode(digest).decode("ascii"))
+
+
+def describe_errors(resp):
+    errors = resp.error_response if isinstance(resp.error_response, dict) else {}
+    messages = [e.get("message") or e.get("code") for e in errors.get("generalErrors", [])]
+    for field_errors in errors.get("fieldErrors", {}).values():
+        messages.extend(e.get("message") or e.get("code") for e in field_errors)
+    return "; ".join(messages) or f"status {resp.status}"
+
+
+class Checkpoint:
+    """Which input rows are done, successfully or not. All rows before `next_row` are,
+    and so are the rows in `done`: ranges (inclusive) of batches that finished ahead of
+    an earlier batch.
+    """
+
+    def __init__(self, path, input_path):
+        self.path = path
+        self.input_path = os.path.abspath(input_path)
+        self.next_row = 1
+        self.done = []
+        self.imported = 0
+        self.failed = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state["input"] != self.input_path:
+                raise ImportAborted(f"{path} is the checkpoint of another input file, {state['input']}")
+            self.next_row = state["next_row"]
+            self.done = state["done"]
+            self.imported = state["imported"]
+            self.failed = state["failed"]
+
+    def is_done(self, number):
+        return number < self.next_row or any(start <= number <= end for start, end in self.done)
+
+    def complete(self, start, end):
+        self.done.append([start, end])
+        self.done.sort()
+        while self.done and self.done[0][0] <= self.next_row:
+            self.next_row = max(self.next_row, self.done.pop(0)[1] + 1)
+
+    def save(self):
+        state = {"input": self.input_path, "next_row": self.next_row, "done": self.done,
+            "imported": self.imported, "failed": self.failed}
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+
+async def import_batch(client, batch, retries):
+    """Import a batch of (row number, user). Returns the (row number, user, error) of
+    the rows FusionAuth rejected.
+    """
+    users = [user for _, user in batch]
+    for attempt in range(retries + 1):
+        try:
+            resp = await client.import_users({"users": users, "validateDbConstraints": True})
+            break
+        except UpstreamUnavailable as e:
+            if attempt == retries:
+                raise ImportAborted(f"rows {batch[0][0]}-{batch[-1][0]}: {e}") from e
+            await asyncio.sleep(2 ** attempt)
+    if resp.was_successful():
+        return []
+    if resp.status != 400:
+        raise ImportAborted(f"rows {batch[0][0]}-{batch[-1][0]}: {describe_errors(resp)}")
+    if len(batch) == 1:
+        number, user = batch[0]
+        return [(number, user, describe_errors(resp))]
+    middle = len(batch) // 2
+    return await import_batch(client, batch[:middle], retries) + await import_batch(client, batch[middle:], retries)
+
+
+async def run(args):
+    checkpoint = Checkpoint(args.checkpoint, args.input)
+    client = AsyncFusionAuthClient(args.api_key, args.url, timeout=args.timeout, pool_size=args.concurrency)
+    loop = asyncio.get_running_loop()
+    # Bounded, so that reading the input stays just ahead of the imports
+    queue = asyncio.Queue(maxsize=args.concurrency)
+    seen = set() # emails in this run, to catch duplicates within the file
+    started = time.perf_counter()
+    reported = started
+    counts = {"imported": 0, "failed": 0}
+
+    with open(args.failures, "a", encoding="utf-8") as failures:
+
+        def fail(number, email, error):
+            failures.write(json.dumps({"row": number, "email": email, "error": error}) + "\n")
+            checkpoint.failed += 1
+            counts["failed"] += 1
+
+        def report(final=False):
+            nonlocal reported
+            now = time.perf_counter()
+            if not final and now - reported < args.progress_interval:
+                return
+            reported = now
+            done = counts["imported"] + counts["failed"]
+            print(
+                f"{counts['imported']} imported, {counts['failed']} failed, "
+                f"{done / max(now - started, 1e-9):.0f} rows/s "
+                f"(total {checkpoint.imported} imported, {checkpoint.failed} failed, "
+                f"next row {checkpoint.next_row})",
+                file=sys.stderr)
+
+        async def produce():
+            # Rows that fail validation are reported along with the batch covering
+            # them, so that they are checkpointed, and not reported again on resume,
+            # at the same time.
+            batch, invalid = [], []
+            start = checkpoint.next_row
+            last = start - 1
+            for number, row in read_rows(args.input, args.format):
+                last = number
+                if checkpoint.is_done(number):
+                    continue
+                try:
+                    user = to_user(row, args.application_id)
+                    if user["email"].lower() in seen:
+                        raise ValueError("duplicate email in the input")
+                except ValueError as e:
+                    invalid.append((number, row.get("email") if isinstance(row, dict) else None, str(e)))
+                    continue
+                seen.add(user["email"].lower())
+                batch.append((number, user))
+                if len(batch) >= args.batch_size:
+                    await queue.put((start, last, batch, invalid))
+                    batch, invalid, start = [], [], last + 1
+            if last >= start:
+                await queue.put((start, last, batch, invalid))
+            for _ in range(args.concurrency):
+                await queue.put(None)
+
+        async def work():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                start, end, batch, invalid = item
+                for number, email, error in invalid:
+                    fail(number, email, error)
+                if batch:
+                    await loop.run_in_executor(None, hash_passwords, [user for _, user in batch])
+                    failed = await import_batch(client, batch, args.retries)
+                    for number, user, error in failed:
+                        fail(number, user["email"], error)
+                    imported = len(batch) - len(failed)
+                    checkpoint.imported += imported
+                    counts["imported"] += imported
+                checkpoint.complete(start, end)
+                failures.flush()
+                checkpoint.save()
+                report()
+
+        tasks = [asyncio.ensure_future(produce())] + [asyncio.ensure_future(work()) for _ in range(args.concurrency)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await client.aclose()
+            report(final=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import users into FusionAuth from CSV or JSON Lines.")
+    parser.add_argument("input", help="CSV file with a header row, or JSON Lines")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="default: from the file extension")
+    parser.add_argument("--batch-size", type=int, default=500, help="users per import request")
+    parser.add_argument("--concurrency", type=int, default=4, help="import requests in flight at once")
+    parser.add_argument("--retries", type=int, default=3, help="per batch, if FusionAuth is unavailable")
+    parser.add_argument("--timeout", type=float, default=60.0, help="per import request, seconds")
+    parser.add_argument("--checkpoint", help="default: INPUT.checkpoint.json")
+    parser.add_argument("--failures", help="default: INPUT.failures.jsonl")
+    parser.add_argument("--progress-interval", type=float, default=5.0, help="seconds")
+    parser.add_argument("--url", default="http://{}:{}".format(
+        os.environ.get("FUSIONAUTH_HOST_IP", "localhost"), os.environ.get("FUSIONAUTH_HOST_PORT", "9011")))
+    parser.add_argument("--api-key", default=os.environ.get("FUSIONAUTH_API_KEY"))
+    parser.add_argument("--application-id", default=os.environ.get("FUSIONAUTH_CLIENT_ID"))
+    args = parser.parse_args()
+    if not args.api_key or not args.application_id:
+        parser.error("set FUSIONAUTH_API_KEY and FUSIONAUTH_CLIENT_ID, or pass --api-key and --application-id")
+    if args.format is None:
+        args.format = "jsonl" if args.input.endswith((".jsonl", ".ndjson", ".json")) else "csv"
+    args.checkpoint = args.checkpoint or args.input + ".checkpoint.json"
+    args.failures = args.failures or args.input + ".failures.jsonl"
+
+    try:
+        asyncio.run(run(args))
+    except ImportAborted as e:
+        print(f"Import stopped: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
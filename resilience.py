@@ -0,0 +1,130 @@
+"""
+Protection against a slow or failing FusionAuth.
+
+Without it, every request that needs FusionAuth waits on it for as long as the client
+timeout allows. When FusionAuth slows down, requests pile up until the whole app is
+unresponsive. The client (see fusion.py) therefore goes through:
+
+- a `Bulkhead`, which caps the number of concurrent FusionAuth calls and turns away
+  calls that cannot get a slot quickly, instead of queueing them indefinitely;
+- a `CircuitBreaker`, which stops calling FusionAuth for a while once too many recent
+  calls failed, and then lets single probe calls through until one succeeds.
+
+Calls that are turned away, time out or fail with a server error raise
+`UpstreamUnavailable`. The app answers those with a 503, except where it can carry on
+with what it already knows (see the stale users in cache.py).
+"""
+import asyncio
+import contextlib
+import time
+from collections import deque
+
+
+class UpstreamUnavailable(Exception):
+    """FusionAuth could not be used for `operation`. `reason` is one of circuit_open,
+    bulkhead_full, timeout, error (connection errors) or server_error (5xx).
+    """
+
+    def __init__(self, operation, reason, detail=None):
+        super().__init__(f"FusionAuth {operation}: {reason}" + (f" ({detail})" if detail else ""))
+        self.operation = operation
+        self.reason = reason
+
+
+class Bulkhead:
+
+    def __init__(self, limit=20, max_wait=0.5):
+        """At most `limit` calls at a time. A call waits up to `max_wait` seconds for a
+        slot before it is rejected.
+        """
+        self.limit = limit
+        self.max_wait = max_wait
+        self.rejected = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, operation):
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.max_wait)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise UpstreamUnavailable(operation, "bulkhead_full") from None
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+
+class CircuitBreaker:
+    """Closed: calls go through and their outcomes are recorded. Once at least
+    `min_calls` calls within the last `window` seconds were made and `failure_rate` of
+    them failed, the breaker opens: calls are rejected for `reset_timeout` seconds.
+    After that it is half open, letting one probe call through at a time. A successful
+    probe closes it, a failed one opens it again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_rate=0.5, min_calls=20, window=10.0, reset_timeout=5.0):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.rejected = 0
+        self._opened_at = None
+        self._probing = False
+        self._outcomes = deque() # (time, failed) within the window
+        self._failures = 0
+
+    def _trim(self, now):
+        while self._outcomes and self._outcomes[0][0] <= now - self.window:
+            _, failed = self._outcomes.popleft()
+            self._failures -= failed
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        self._failures = 0
+
+    def before_call(self, operation):
+        """Raise UpstreamUnavailable if the call may not go through. Otherwise the call's
+        outcome must be reported with `record`, or `release` if it has none.
+        """
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self._opened_at < self.reset_timeout:
+                self.rejected += 1
+                raise UpstreamUnavailable(operation, "circuit_open")
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                self.rejected += 1
+                raise UpstreamUnavailable(operation, "circuit_open")
+            self._probing = True
+
+    def record(self, failed):
+        now = time.monotonic()
+        if self.state == self.HALF_OPEN:
+            self._probing = False
+            if failed:
+                self._open(now)
+            else:
+                self.state = self.CLOSED
+            return
+        if self.state == self.OPEN:
+            return # a call that started before the breaker opened
+        self._trim(now)
+        self._outcomes.append((now, failed))
+        self._failures += failed
+        if len(self._outcomes) >= self.min_calls and self._failures >= self.failure_rate * len(self._outcomes):
+            self._open(now)
+
+    def release(self):
+        """The call ended without an outcome (e.g. it was cancelled)."""
+        if self.state == self.HALF_OPEN:
+            self._probing = False
+
+    def stats(self):
+        return {"state": self.state, "rejected": self.rejected}
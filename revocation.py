@@ -0,0 +1,181 @@
+"""
+Local revocation of access tokens.
+
+FusionAuth cannot revoke the JWTs it issues as access tokens: a token stays valid until
+it expires, logged out or not. With USE_TOKENS = True the app keeps its own denylist of
+revoked token ids (`jti`), and of per user cutoffs that revoke all of a user's tokens
+issued before a point in time (for logging out everywhere, and deactivated users).
+
+The denylist lives in a SQLite database shared by all worker processes. Each worker
+keeps a Bloom filter of the revoked token ids and a dict of the user cutoffs (there are
+few of those), updated by polling the database for new entries every `sync_interval`
+seconds. Checking a token is an in-memory lookup; only a Bloom filter hit, almost
+always a token that really was revoked, is confirmed against the database. Entries
+are deleted once the tokens they revoke would have expired anyway, and the Bloom
+filters rebuilt to let go of them.
+
+A revocation made by another worker takes effect in this one within `sync_interval`.
+"""
+import asyncio
+import hashlib
+import math
+import sqlite3
+import threading
+import time
+from starlette.concurrency import run_in_threadpool
+
+
+class BloomFilter:
+    """Set membership in about 1.8 bytes per key at a 0.1% false positive rate. Keys
+    cannot be removed; build a new filter instead.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self._positions(key):
+            self._bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+
+class RevocationList:
+
+    SCHEMA = [
+        # Append only, so that `seq` tells workers which entries they have not seen yet
+        "CREATE TABLE IF NOT EXISTS revocations ("
+        " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " kind TEXT NOT NULL," # token or user
+        " key TEXT NOT NULL," # the token's jti, or the user id
+        " issued_before REAL," # for users: tokens issued before this are revoked
+        " expires_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS revocations_key ON revocations (key)",
+        "CREATE INDEX IF NOT EXISTS revocations_expires_at ON revocations (expires_at)",
+    ]
+    INSERT = "INSERT INTO revocations (kind, key, issued_before, expires_at) VALUES (?, ?, ?, ?)"
+    SINCE = "SELECT seq, kind, key, issued_before FROM revocations WHERE seq > ? AND expires_at > ?"
+    TOKEN_REVOKED = "SELECT 1 FROM revocations WHERE key = ? AND kind = 'token' AND expires_at > ? LIMIT 1"
+    SWEEP = "DELETE FROM revocations WHERE expires_at <= ?"
+
+    def __init__(self, path="revocations.db", *, max_token_ttl=3600, grace=0.0, capacity=100000,
+            busy_timeout=5.0, sync_interval=1.0, rebuild_interval=300.0):
+        """`max_token_ttl` is the access token lifetime configured in FusionAuth ("JWT
+        duration"), which bounds how long a user cutoff must be kept. `grace` is how
+        long past its expiry a token may still be accepted (backends.DEGRADED_GRACE).
+        `capacity` is the number of revoked tokens the Bloom filter is sized for; it
+        grows on rebuild if needed.
+        """
+        self.path = str(path)
+        self.max_token_ttl = max_token_ttl
+        self.grace = grace
+        self.capacity = capacity
+        self.busy_timeout = busy_timeout
+        self.sync_interval = sync_interval
+        self.rebuild_interval = rebuild_interval
+        self.lookups = 0 # Bloom filter hits confirmed against the database
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            for sql in self.SCHEMA:
+                conn.execute(sql)
+        self._rebuild()
+
+    def _connection(self):
+        # One connection per thread, as in store.SQLiteStore
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _query(self, sql, params):
+        return self._connection().execute(sql, params).fetchall()
+
+    @staticmethod
+    def _apply(rows, tokens, users, seq):
+        for row_seq, kind, key, issued_before in rows:
+            if kind == "token":
+                tokens.add(key)
+            elif issued_before > users.get(key, 0):
+                users[key] = issued_before
+            seq = max(seq, row_seq)
+        return seq
+
+    def _rebuild(self):
+        # Runs in a thread: build the new structures aside and swap them in at once
+        rows = self._query(self.SINCE, (0, time.time()))
+        tokens = BloomFilter(max(self.capacity, 2 * sum(1 for row in rows if row[1] == "token")))
+        users = {} # user id -> issued_before cutoff
+        seq = self._apply(rows, tokens, users, 0)
+        self._tokens, self._users, self._seq = tokens, users, seq
+        self._rebuilt_at = time.monotonic()
+
+    async def sync(self):
+        """Pick up entries added by other workers. Every `rebuild_interval`, delete the
+        expired entries and rebuild the in-memory structures without them instead.
+        """
+        if time.monotonic() - self._rebuilt_at >= self.rebuild_interval:
+            await run_in_threadpool(self._query, self.SWEEP, (time.time(),))
+            await run_in_threadpool(self._rebuild)
+        else:
+            rows = await run_in_threadpool(self._query, self.SINCE, (self._seq, time.time()))
+            self._seq = self._apply(rows, self._tokens, self._users, self._seq)
+
+    async def run_sync(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except sqlite3.Error:
+                pass # e.g. the database stayed locked past busy_timeout; try again next round
+
+    async def revoke_token(self, jti, expires_at):
+        """Revoke one token. `expires_at` is its `exp` claim."""
+        await run_in_threadpool(self._query, self.INSERT, ("token", jti, None, expires_at + self.grace))
+        self._tokens.add(jti)
+
+    async def revoke_user(self, user_id, include_current_second=False):
+        """Revoke all of the user's tokens issued before the current second.
+
+        `iat` has whole second resolution, so a token issued in the same second as the
+        revocation cannot be told apart from one issued just after it (e.g. by logging
+        in again right after a logout everywhere). Those are left valid, unless
+        `include_current_second` is set: for deleted or deactivated users, who cannot
+        get new tokens anyway.
+        """
+        now = time.time()
+        cutoff = math.floor(now) + (1 if include_current_second else 0)
+        await run_in_threadpool(
+            self._query, self.INSERT, ("user", user_id, cutoff, now + self.max_token_ttl + self.grace))
+        self._users[user_id] = max(cutoff, self._users.get(user_id, 0))
+
+    async def is_revoked(self, claims):
+        """Whether the token with these (verified) claims has been revoked."""
+        cutoff = self._users.get(claims.get("sub"))
+        if cutoff is not None and claims.get("iat", 0) < cutoff:
+            return True
+        jti = claims.get("jti")
+        if jti is None or jti not in self._tokens:
+            return False
+        self.lookups += 1
+        rows = await run_in_threadpool(self._query, self.TOKEN_REVOKED, (jti, time.time()))
+        return bool(rows)
+
+    def stats(self):
+        return {"tokens": self._tokens.count, "users": len(self._users), "lookups": self.lookups}
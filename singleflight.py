@@ -0,0 +1,67 @@
+"""
+In-process coalescing of identical concurrent upstream calls.
+
+A browser loading a page fires several requests at once with the same session cookie,
+and without coordination each of them makes the same FusionAuth call. `SingleFlight`
+lets the first caller for a key make the call while concurrent callers with the same
+key wait for and share its result.
+"""
+import asyncio
+import time
+
+
+class SingleFlight:
+
+    def __init__(self, remember=0.0):
+        """`remember` keeps a successful result around for that many seconds after the
+        call completes, so that callers arriving just after it finished also share it.
+        This matters for calls that cannot be repeated, like exchanging a refresh token
+        that FusionAuth rotates on use.
+        """
+        self.remember = remember
+        self.calls = 0 # upstream calls actually made
+        self.shared = 0 # callers served by another caller's call
+        self._inflight = {} # key -> Task
+        self._results = {} # key -> (expires_at, result)
+
+    def _recent(self, key):
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._results[key]
+            return None
+        return entry
+
+    def _purge(self):
+        now = time.monotonic()
+        for key in [k for k, (expires_at, _) in self._results.items() if expires_at <= now]:
+            del self._results[key]
+
+    async def do(self, key, fn):
+        """Return the result of `await fn()`, sharing one call among concurrent callers
+        with the same key. Exceptions are shared the same way.
+        """
+        entry = self._recent(key)
+        if entry is not None:
+            self.shared += 1
+            return entry[1]
+        task = self._inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.shared += 1
+        # Shielded so that one caller going away (e.g. a client disconnect) does not
+        # cancel the call for everybody else waiting on it.
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        self._inflight.pop(key, None)
+        if task.cancelled():
+            return
+        if task.exception() is None and self.remember > 0:
+            self._purge()
+            self._results[key] = (time.monotonic() + self.remember, task.result())
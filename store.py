@@ -1,53 +1,477 @@
+import asyncio
+import hashlib
 import json
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
 from pathlib import Path
-from typing import Dict
-from starsessions import SessionStore, Serializer
+import msgpack
+from starlette.concurrency import run_in_threadpool
+from starsessions import JsonSerializer, SessionStore, Serializer
+from singleflight import SingleFlight
+import metrics
+import tracing
 
 
 SESSIONS_DIR = Path(".sessions")
-SESSIONS_DIR.mkdir(parents=True, exist_ok=True)
 
 
-#class FSStoreSerializer(Serializer):
-#
-#    def serialize(self, data: typing.Any) -> bytes:
-#        return json.dumps(data).encode('utf-8')
-#
-#    def deserialize(self, data: bytes) -> typing.Dict[str, typing.Any]:
-#        return json.loads(data)
+def without_last_access(data):
+    """starsessions stamps `__metadata__.last_access` with the current time every time a
+    session is loaded, so without dropping it every response would serialize to
+    different bytes even when nothing in the session changed, and ThrottledStore could
+    never skip a write. Nothing in this app reads `last_access`.
+    """
+    metadata = data.get("__metadata__")
+    if metadata and "last_access" in metadata:
+        data = dict(data, __metadata__={k: v for k, v in metadata.items() if k != "last_access"})
+    return data
+
+
+class SessionSerializer(JsonSerializer):
+    """JSON serializer that leaves out the `last_access` session metadata."""
+
+    def serialize(self, data):
+        return super().serialize(without_last_access(data))
+
+
+class CompactSerializer(Serializer):
+    """msgpack serializer that leaves out the `last_access` session metadata, and
+    zlib-compresses sessions larger than `compress_threshold` bytes.
+
+    The first byte says how the rest is encoded. Sessions saved by SessionSerializer
+    (JSON) are still read, so switching serializers does not log anybody out.
+    """
+    RAW = b"\x00"
+    COMPRESSED = b"\x01"
+
+    def __init__(self, compress_threshold=1024, compress_level=6):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def serialize(self, data):
+        packed = msgpack.packb(without_last_access(data), use_bin_type=True)
+        if len(packed) > self.compress_threshold:
+            return self.COMPRESSED + zlib.compress(packed, self.compress_level)
+        return self.RAW + packed
+
+    def deserialize(self, data):
+        if not data:
+            return {}
+        tag, body = data[:1], data[1:]
+        if tag == self.RAW:
+            return msgpack.unpackb(body, raw=False)
+        if tag == self.COMPRESSED:
+            return msgpack.unpackb(zlib.decompress(body), raw=False)
+        return json.loads(data)
+
+
+SERIALIZERS = {
+    "json": SessionSerializer,
+    "compact": CompactSerializer,
+}
+
+
+# Each session file starts with its expiry time (unix seconds) followed by the
+# session data exactly as serialized by the session middleware.
+HEADER = struct.Struct(">d")
+SHARDS = 256 * 256
 
 
- 
 class FilesystemStore(SessionStore):
+    """Session files are spread over 256 * 256 subdirectories named by a hash of the
+    session id, so no single directory grows large even with millions of sessions.
+
+    Writes go to a temporary file that is renamed into place, so a concurrent reader
+    sees either the old or the new session, never a partial one. Expired sessions are
+    treated as missing, and are deleted a few directories at a time by `run_sweeper`,
+    which the app runs as a background task.
+    """
+    supports_user_index = False
 
-    #def __init__(self):
-    #    self._storage = {}
+    def __init__(self, directory=SESSIONS_DIR, default_ttl=60 * 60 * 24,
+            sweep_interval=1.0, sweep_batch=256):
+        """`default_ttl` applies to browser-session cookies (session lifetime of 0), for
+        which the middleware gives no expiry. Each sweep pass visits `sweep_batch` shard
+        directories, so a full pass over the store takes about
+        SHARDS / sweep_batch * sweep_interval seconds.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.default_ttl = default_ttl
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._sweep_cursor = 0
 
     def session_file(self, session_id):
-        return SESSIONS_DIR / session_id
+        digest = hashlib.sha256(session_id.encode("utf-8")).hexdigest()
+        return self.directory / digest[:2] / digest[2:4] / digest
 
-    async def read(self, session_id: str, lifetime: int) -> Dict:
+    def _shard_dir(self, shard):
+        return self.directory / f"{shard >> 8:02x}" / f"{shard & 0xff:02x}"
+
+    def _read(self, path):
+        try:
+            with path.open("rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return b""
+        if len(raw) < HEADER.size:
+            return b""
+        (expires_at,) = HEADER.unpack_from(raw)
+        if expires_at <= time.time():
+            path.unlink(missing_ok=True)
+            return b""
+        return raw[HEADER.size:]
+
+    def _write(self, path, data, expires_at):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(HEADER.pack(expires_at))
+                f.write(data)
+            # The mtime doubles as the expiry so the sweeper can decide from a stat alone
+            os.utime(tmp, (expires_at, expires_at))
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+    def _exists(self, path):
+        try:
+            with path.open("rb") as f:
+                header = f.read(HEADER.size)
+        except FileNotFoundError:
+            return False
+        return len(header) == HEADER.size and HEADER.unpack(header)[0] > time.time()
+
+    @metrics.timed_store_operation("read")
+    async def read(self, session_id: str, lifetime: int) -> bytes:
         """ Read session data from a data source using session_id. """
-        #return self._storage.get(session_id, {})
-        f = self.session_file(session_id)
+        return await run_in_threadpool(self._read, self.session_file(session_id))
+
+    @metrics.timed_store_operation("write")
+    async def write(self, session_id: str, data: bytes, lifetime: int, ttl: int) -> str:
+        """ Write session data into data source and return session id. """
+        expires_at = time.time() + (ttl if ttl > 0 else self.default_ttl)
+        await run_in_threadpool(self._write, self.session_file(session_id), data, expires_at)
+        return session_id
+
+    @metrics.timed_store_operation("remove")
+    async def remove(self, session_id: str):
+        """ Remove session data. """
+        await run_in_threadpool(self.session_file(session_id).unlink, missing_ok=True)
+
+    @metrics.timed_store_operation("exists")
+    async def exists(self, session_id: str) -> bool:
+        return await run_in_threadpool(self._exists, self.session_file(session_id))
+
+    def _sweep_dirs(self, shards):
+        now = time.time()
+        removed = 0
+        for shard in shards:
+            try:
+                entries = os.scandir(self._shard_dir(shard))
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat()
+                        if entry.name.startswith(".tmp-"):
+                            # Left behind by a crashed write. ctime, since mtime may already
+                            # have been set to the expiry.
+                            if stat.st_ctime < now - 60:
+                                os.unlink(entry.path)
+                        elif stat.st_mtime <= now:
+                            os.unlink(entry.path)
+                            removed += 1
+                    except FileNotFoundError:
+                        pass
+        return removed
+
+    async def sweep(self):
+        """Delete expired sessions from the next `sweep_batch` shard directories."""
+        start = self._sweep_cursor
+        shards = [(start + i) % SHARDS for i in range(self.sweep_batch)]
+        self._sweep_cursor = (start + self.sweep_batch) % SHARDS
+        return await run_in_threadpool(self._sweep_dirs, shards)
+
+    async def run_sweeper(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except OSError:
+                pass # e.g. a shard directory removed underneath us; try again next round
+
+
+class SQLiteStore(SessionStore):
+    """Session store on a single SQLite database in WAL mode, which lets any number of
+    worker processes read concurrently while writes are serialized by SQLite's own
+    locking.
+
+    Writes made at about the same time within a process are committed together in one
+    transaction (a "group commit"); each write still only returns once its transaction
+    is committed. Statements are fixed strings, so sqlite3 compiles each one once per
+    connection and reuses it from its statement cache.
+
+    Sessions can be associated with a user id (`index_user`), which allows listing and
+    revoking all of a user's sessions in one query.
+    """
+    supports_user_index = True
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS sessions ("
+        " id TEXT PRIMARY KEY,"
+        " data BLOB NOT NULL,"
+        " expires_at REAL NOT NULL,"
+        " user_id TEXT,"
+        " revoked INTEGER NOT NULL DEFAULT 0)",
+        "CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)",
+        "CREATE INDEX IF NOT EXISTS sessions_user_id ON sessions (user_id) WHERE user_id IS NOT NULL",
+    ]
+    # A write to a revoked session is ignored, so that a request which was in flight
+    # during the revocation cannot save the session back.
+    WRITE = (
+        "INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?) "
+        "ON CONFLICT (id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at "
+        "WHERE revoked = 0")
+    READ = "SELECT data FROM sessions WHERE id = ? AND expires_at > ? AND revoked = 0"
+    EXISTS = "SELECT 1 FROM sessions WHERE id = ? AND expires_at > ? AND revoked = 0"
+    REMOVE = "DELETE FROM sessions WHERE id = ?"
+    INDEX_USER = (
+        "INSERT INTO sessions (id, data, expires_at, user_id) VALUES (?, x'', ?, ?) "
+        "ON CONFLICT (id) DO UPDATE SET user_id = excluded.user_id")
+    USER_SESSIONS = "SELECT id FROM sessions WHERE user_id = ? AND expires_at > ? AND revoked = 0"
+    # Revoked sessions are kept as tombstones for a while instead of being deleted,
+    # for the reason given above WRITE. The sweeper deletes them afterwards.
+    REVOKE_USER = (
+        "UPDATE sessions SET revoked = 1, data = x'', expires_at = ? "
+        "WHERE user_id = ? AND revoked = 0")
+    SWEEP = (
+        "DELETE FROM sessions WHERE id IN "
+        "(SELECT id FROM sessions WHERE expires_at <= ? LIMIT ?)")
+    TOMBSTONE_SECONDS = 300
+
+    def __init__(self, path="sessions.db", default_ttl=60 * 60 * 24, busy_timeout=5.0,
+            batch_window=0.002, max_batch=200, sweep_interval=1.0, sweep_batch=1000):
+        """`batch_window` is how long (seconds) a write waits for others to share its
+        commit, `max_batch` the most statements committed together. `busy_timeout` is
+        how long to wait on another process holding the write lock.
+        """
+        self.path = str(path)
+        self.default_ttl = default_ttl
+        self.busy_timeout = busy_timeout
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._local = threading.local()
+        self._pending = [] # (sql, params, future) waiting for the next commit
+        self._flushing = False
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            for sql in self.SCHEMA:
+                conn.execute(sql)
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads, and the threadpool
+        # runs on several. One connection per thread, reused across calls.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL") # durable enough in WAL mode, much faster
+            self._local.conn = conn
+        return conn
+
+    def _query(self, sql, params):
+        return self._connection().execute(sql, params).fetchall()
+
+    def _commit(self, batch):
+        conn = self._connection()
+        results = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, params in batch:
+                results.append(conn.execute(sql, params).rowcount)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return results
+
+    async def _execute(self, sql, params):
+        """Queue a write statement for the next group commit and wait for the commit.
+        Returns the statement's rowcount."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((sql, params, future))
+        if not self._flushing:
+            self._flushing = True
+            asyncio.ensure_future(self._flush())
+        return await future
+
+    async def _flush(self):
         try:
-            if f.exists():
-                return json.load(f.open())
-        except OSError: # happens if a lingering session cookie from Starlette's builtin sessions results in filename too long
-            pass
-        return {}
+            await asyncio.sleep(self.batch_window)
+            while self._pending:
+                batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+                try:
+                    results = await run_in_threadpool(self._commit, [(sql, params) for sql, params, _ in batch])
+                except Exception as exc:
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(exc)
+                else:
+                    for (_, _, future), result in zip(batch, results):
+                        if not future.done():
+                            future.set_result(result)
+        finally:
+            self._flushing = False
 
-    async def write(self, session_id: str, data: Dict, lifetime: int, ttl: int) -> str:
+    @metrics.timed_store_operation("read")
+    async def read(self, session_id: str, lifetime: int) -> bytes:
+        """ Read session data from a data source using session_id. """
+        rows = await run_in_threadpool(self._query, self.READ, (session_id, time.time()))
+        return rows[0][0] if rows else b""
+
+    @metrics.timed_store_operation("write")
+    async def write(self, session_id: str, data: bytes, lifetime: int, ttl: int) -> str:
         """ Write session data into data source and return session id. """
-        json.dump(data.decode("utf-8"), self.session_file(session_id).open("w"))
-        #self._storage[session_id] = data
+        expires_at = time.time() + (ttl if ttl > 0 else self.default_ttl)
+        await self._execute(self.WRITE, (session_id, data, expires_at))
         return session_id
 
+    @metrics.timed_store_operation("remove")
     async def remove(self, session_id: str):
         """ Remove session data. """
-        #del self._storage[session_id]
-        self.session_file(session_id).unlink()
+        await self._execute(self.REMOVE, (session_id,))
+
+    @metrics.timed_store_operation("exists")
+    async def exists(self, session_id: str) -> bool:
+        rows = await run_in_threadpool(self._query, self.EXISTS, (session_id, time.time()))
+        return bool(rows)
+
+    async def index_user(self, session_id, user_id):
+        """Associate a session with a user. Can be called before the session itself
+        has been written, e.g. right after login."""
+        await self._execute(self.INDEX_USER, (session_id, time.time() + self.default_ttl, user_id))
+
+    async def user_sessions(self, user_id):
+        rows = await run_in_threadpool(self._query, self.USER_SESSIONS, (user_id, time.time()))
+        return [row[0] for row in rows]
+
+    async def revoke_user(self, user_id):
+        """Revoke all of the user's sessions. Returns the number revoked."""
+        return await self._execute(self.REVOKE_USER, (time.time() + self.TOMBSTONE_SECONDS, user_id))
+
+    async def sweep(self):
+        """Delete up to `sweep_batch` expired sessions."""
+        return await self._execute(self.SWEEP, (time.time(), self.sweep_batch))
+
+    async def run_sweeper(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except sqlite3.Error:
+                pass # e.g. the database stayed locked past busy_timeout; try again next round
+
+
+class ThrottledStore(SessionStore):
+    """Wraps another store and skips writes that would not change anything.
+
+    The session middleware saves the session on every response. This remembers a
+    fingerprint of each session as last read or written by this process, and skips the
+    write when the data is unchanged and the expiry would move by less than
+    `refresh_interval` seconds. For non-rolling sessions the expiry never moves, so
+    unchanged sessions are never rewritten. Rolling sessions get their expiry pushed
+    out at most once per `refresh_interval`. Concurrent writes of the same data to the
+    same session are made once.
+
+    Anything else (index_user, revoke_user, run_sweeper, ...) is passed through to the
+    wrapped store.
+    """
+
+    def __init__(self, store, refresh_interval=300, maxsize=100000):
+        self.store = store
+        self.refresh_interval = refresh_interval
+        self.maxsize = maxsize
+        self.writes = 0
+        self.skipped_writes = 0
+        self._seen = OrderedDict() # session_id -> (digest, expiry target as of last write, or None)
+        self._flight = SingleFlight()
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    @staticmethod
+    def _digest(data):
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def _remember(self, session_id, digest, expires_at):
+        self._seen[session_id] = (digest, expires_at)
+        self._seen.move_to_end(session_id)
+        if len(self._seen) > self.maxsize:
+            self._seen.popitem(last=False)
+
+    async def read(self, session_id: str, lifetime: int) -> bytes:
+        data = await self.store.read(session_id, lifetime)
+        if data:
+            previous = self._seen.get(session_id)
+            digest = self._digest(data)
+            # Keep the known expiry only if nobody else has written the session since
+            expires_at = previous[1] if previous is not None and previous[0] == digest else None
+            self._remember(session_id, digest, expires_at)
+        else:
+            self._seen.pop(session_id, None)
+        return data
+
+    async def write(self, session_id: str, data: bytes, lifetime: int, ttl: int) -> str:
+        digest = self._digest(data)
+        # A ttl of 0 (browser-session cookie) lets the wrapped store pick the expiry,
+        # which is then relative to the time of the write.
+        expires_at = time.time() + max(ttl, 0)
+        previous = self._seen.get(session_id)
+        if (previous is not None and previous[0] == digest and previous[1] is not None
+                and expires_at - previous[1] < self.refresh_interval):
+            self.skipped_writes += 1
+            metrics.SESSION_WRITES.labels("skipped").inc()
+            return session_id
+        wrote = False
+
+        async def write():
+            nonlocal wrote
+            wrote = True
+            with tracing.span("session.write"):
+                new_id = await self.store.write(session_id, data, lifetime, ttl)
+            self._remember(new_id, digest, expires_at)
+            return new_id
+
+        # Concurrent requests saving the very same data (e.g. the tokens from a shared
+        # refresh) share one write
+        session_id = await self._flight.do((session_id, digest), write)
+        if wrote:
+            self.writes += 1
+            metrics.SESSION_WRITES.labels("written").inc()
+        else:
+            self.skipped_writes += 1
+            metrics.SESSION_WRITES.labels("skipped").inc()
+        return session_id
+
+    async def remove(self, session_id: str):
+        self._seen.pop(session_id, None)
+        await self.store.remove(session_id)
 
     async def exists(self, session_id: str) -> bool:
-        #return session_id in self._storage
-        return self.session_file(session_id).exists()
+        return await self.store.exists(session_id)
+
+    def stats(self):
+        return {"writes": self.writes, "skipped_writes": self.skipped_writes}
@@ -0,0 +1,20 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# backends and main read their configuration at import. Keep their files out of the
+# checkout; nothing in the tests talks to a real FusionAuth.
+_workdir = tempfile.mkdtemp(prefix="fa-tests-")
+for name, value in {
+    "FUSIONAUTH_API_KEY": "test-api-key",
+    "FUSIONAUTH_CLIENT_ID": "test-client-id",
+    "FUSIONAUTH_CLIENT_SECRET": "test-client-secret",
+    "FUSIONAUTH_HOST_PORT": "1", # nothing listens there
+    "SESSION_DIR": os.path.join(_workdir, "sessions"),
+    "SESSION_DB": os.path.join(_workdir, "sessions.db"),
+    "REVOCATION_DB": os.path.join(_workdir, "revocations.db"),
+    "TEMPLATE_CACHE_DIR": os.path.join(_workdir, "templates_cache"),
+}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+import time
+import httpx
+import jwt
+import pytest
+import backends
+from fusion import ClientResponse
+from resilience import UpstreamUnavailable
+
+
+class FakeRequest:
+
+    def __init__(self, session):
+        self.session = session
+
+
+async def no_session_load(request):
+    pass
+
+
+def record(**overrides):
+    record = {"active": True, "id": "u1", "email": "u1@example.com", "insertInstant": 1,
+        "lastUpdateInstant": 1, "lastLoginInstant": 1, "passwordLastUpdateInstant": 1,
+        "passwordChangeRequired": False, "registrations": [{"applicationId": backends.CLIENT_ID, "roles": ["admin"]}]}
+    record.update(overrides)
+    return record
+
+
+@pytest.fixture
+def authenticate(monkeypatch):
+    monkeypatch.setattr(backends, "USE_TOKENS", False)
+    monkeypatch.setattr(backends, "load_session", no_session_load)
+
+    def authenticate(user_record):
+        async def get_user(user_id):
+            return backends.User(**user_record)
+        monkeypatch.setattr(backends, "get_user", get_user)
+        request = FakeRequest({"user_id": "u1"})
+        return asyncio.run(backends.SessionAuthBackend().authenticate(request))
+    return authenticate
+
+
+def test_authenticate_registered_user(authenticate):
+    auth, user = authenticate(record())
+    assert user.is_authenticated
+    assert set(auth.scopes) == {"app_auth", "admin"}
+
+
+def test_authenticate_rejects_deactivated_user(authenticate):
+    auth, user = authenticate(record(active=False))
+    assert not user.is_authenticated
+    assert auth.scopes == []
+
+
+def test_authenticate_rejects_unregistered_user(authenticate):
+    _, user = authenticate(record(registrations=[{"applicationId": "other-app"}]))
+    assert not user.is_authenticated
+    _, user = authenticate(record(registrations=[{"applicationId": backends.CLIENT_ID, "roles": ["deactivated"]}]))
+    assert not user.is_authenticated
+
+
+class JWTClient:
+    """Stands in for FusionAuth's retrieve_user_using_jwt; `down` makes it unavailable."""
+
+    def __init__(self):
+        self.down = False
+        self.calls = 0
+
+    async def retrieve_user_using_jwt(self, token):
+        self.calls += 1
+        if self.down:
+            raise UpstreamUnavailable("retrieve_user_using_jwt", "timeout")
+        return ClientResponse(httpx.Response(200, json={"user": record()}))
+
+
+def hmac_token(exp):
+    return jwt.encode({"sub": "u1", "aud": backends.CLIENT_ID, "exp": exp, "iat": int(time.time())},
+        "a-secret-this-app-does-not-know-about", algorithm="HS256")
+
+
+@pytest.fixture
+def jwt_client(monkeypatch):
+    client = JWTClient()
+    monkeypatch.setattr(backends, "client", client)
+    monkeypatch.setattr(backends.token_verifier, "hmac_secret", None)
+    backends.checked_tokens.clear()
+    return client
+
+
+def test_fusionauth_checked_tokens_survive_outage(jwt_client):
+    token = hmac_token(int(time.time()) + 60)
+    assert asyncio.run(backends.verify_access_token(token))["sub"] == "u1"
+    jwt_client.down = True
+    assert asyncio.run(backends.verify_access_token(token))["sub"] == "u1"
+    assert jwt_client.calls == 2
+    with pytest.raises(UpstreamUnavailable):
+        asyncio.run(backends.verify_access_token(hmac_token(int(time.time()) + 61)))
+
+
+def test_fusionauth_checked_expired_token_within_grace(jwt_client, monkeypatch):
+    monkeypatch.setattr(backends, "DEGRADED_GRACE", 300)
+    token = hmac_token(int(time.time()) + 60)
+    asyncio.run(backends.verify_access_token(token))
+    backends.checked_tokens.set(
+        hashlib.blake2b(token.encode(), digest_size=16).digest(),
+        dict(jwt.decode(token, options={"verify_signature": False}), exp=int(time.time()) - 10))
+    jwt_client.down = True
+    assert asyncio.run(backends.verify_access_token(token, leeway=300))["sub"] == "u1"
+    with pytest.raises(jwt.InvalidTokenError):
+        asyncio.run(backends.verify_access_token(token, leeway=5))
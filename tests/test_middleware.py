@@ -0,0 +1,92 @@
+from starlette.applications import Starlette
+from starlette.authentication import AuthCredentials
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+from starsessions import SessionMiddleware, load_session
+import backends
+
+
+class CountingStore:
+    """In-memory session store that counts every call."""
+
+    def __init__(self):
+        self.calls = 0
+        self.data = {}
+
+    async def read(self, session_id, lifetime):
+        self.calls += 1
+        return self.data.get(session_id, b"")
+
+    async def write(self, session_id, data, lifetime, ttl):
+        self.calls += 1
+        self.data[session_id] = data
+        return session_id
+
+    async def remove(self, session_id):
+        self.calls += 1
+        self.data.pop(session_id, None)
+
+    async def exists(self, session_id):
+        self.calls += 1
+        return session_id in self.data
+
+
+class CountingBackend:
+
+    def __init__(self):
+        self.calls = 0
+
+    async def authenticate(self, request):
+        self.calls += 1
+        await load_session(request)
+        return AuthCredentials(["app_auth"]), backends.User.from_claims({"sub": "u1"})
+
+
+async def plain(request):
+    return PlainTextResponse("plain")
+
+
+@backends.with_user
+async def whoami(request):
+    return PlainTextResponse(str(request.user.is_authenticated))
+
+
+async def peek(request):
+    return PlainTextResponse(type(request.user).__name__)
+
+
+def make_app():
+    store = CountingStore()
+    backend = CountingBackend()
+    app = Starlette(routes=[
+        Route("/plain", plain),
+        Route("/whoami", whoami),
+        Route("/static/{path:path}", peek),
+        Route("/static", peek),
+        Route("/staticky", peek),
+        Route("/metrics", peek),
+        Route("/metricsx", peek),
+    ])
+    app.add_middleware(backends.LazyAuthenticationMiddleware, backend=backend,
+        public_paths=["/static/", "/metrics"])
+    app.add_middleware(SessionMiddleware, store=store)
+    return TestClient(app, cookies={"session": "some-session-id"}), store, backend
+
+
+def test_routes_without_user_do_not_authenticate():
+    client, store, backend = make_app()
+    assert client.get("/plain").text == "plain"
+    assert (store.calls, backend.calls) == (0, 0)
+    assert client.get("/whoami").text == "True"
+    assert backend.calls == 1
+    assert store.calls >= 1
+
+
+def test_public_paths_match_whole_segments():
+    client, store, backend = make_app()
+    for path in ("/static", "/static/main.css", "/metrics"):
+        assert client.get(path).text == "UnauthenticatedUser", path
+    for path in ("/staticky", "/metricsx"):
+        assert client.get(path).text == "UnresolvedUser", path
+    assert (store.calls, backend.calls) == (0, 0)
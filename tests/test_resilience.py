@@ -0,0 +1,70 @@
+import pytest
+import resilience
+from resilience import CircuitBreaker, UpstreamUnavailable
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+    return now
+
+
+def call(breaker, failed):
+    breaker.before_call("op")
+    breaker.record(failed)
+
+
+def test_breaker_opens_at_failure_rate(clock):
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=4, window=10, reset_timeout=5)
+    call(breaker, True)
+    call(breaker, True)
+    call(breaker, False)
+    assert breaker.state == CircuitBreaker.CLOSED # not enough calls yet
+    call(breaker, True)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(UpstreamUnavailable) as exc:
+        breaker.before_call("op")
+    assert exc.value.reason == "circuit_open"
+    assert breaker.stats() == {"state": "open", "rejected": 1}
+
+
+def test_breaker_forgets_outcomes_outside_window(clock):
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=4, window=10, reset_timeout=5)
+    for _ in range(3):
+        call(breaker, True)
+    clock[0] += 11
+    call(breaker, True)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_half_open_probe(clock):
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=2, window=10, reset_timeout=5)
+    call(breaker, True)
+    call(breaker, True)
+    assert breaker.state == CircuitBreaker.OPEN
+    clock[0] += 5
+    breaker.before_call("op") # the probe
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(UpstreamUnavailable):
+        breaker.before_call("op") # one probe at a time
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(UpstreamUnavailable):
+        breaker.before_call("op")
+    clock[0] += 5
+    breaker.before_call("op")
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.CLOSED
+    call(breaker, False)
+
+
+def test_breaker_release_frees_probe(clock):
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=2, window=10, reset_timeout=5)
+    call(breaker, True)
+    call(breaker, True)
+    clock[0] += 5
+    breaker.before_call("op")
+    breaker.release() # e.g. the probe was cancelled
+    breaker.before_call("op")
+    assert breaker.state == CircuitBreaker.HALF_OPEN
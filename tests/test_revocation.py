@@ -0,0 +1,43 @@
+import asyncio
+import math
+import time
+from revocation import BloomFilter, RevocationList
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, error_rate=0.01)
+    keys = [f"jti-{i}" for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    false_positives = sum(f"other-{i}" in bloom for i in range(10000))
+    assert false_positives < 300 # about 100 expected at 1%
+    assert bloom.count == 1000
+
+
+def test_revocation_list(tmp_path):
+    async def run():
+        path = tmp_path / "revocations.db"
+        revocations = RevocationList(path, max_token_ttl=60)
+        now = time.time()
+        await revocations.revoke_token("t1", now + 60)
+        assert await revocations.is_revoked({"sub": "u", "jti": "t1", "iat": now})
+        assert not await revocations.is_revoked({"sub": "u", "jti": "t2", "iat": now})
+        await revocations.revoke_user("u")
+        cutoff = revocations._users["u"]
+        assert cutoff == math.floor(cutoff)
+        assert await revocations.is_revoked({"sub": "u", "jti": "t3", "iat": cutoff - 1})
+        # iat has whole second resolution: a token from the same second stays valid
+        assert not await revocations.is_revoked({"sub": "u", "jti": "t3", "iat": cutoff})
+        # For deleted and deactivated users the current second is revoked as well
+        await revocations.revoke_user("w", include_current_second=True)
+        second = revocations._users["w"] - 1
+        assert await revocations.is_revoked({"sub": "w", "jti": "t5", "iat": second})
+        # Another worker picks up the entries
+        other = RevocationList(path, max_token_ttl=60)
+        assert await other.is_revoked({"sub": "u", "jti": "t1", "iat": cutoff})
+        assert await other.is_revoked({"sub": "u", "jti": "t3", "iat": cutoff - 1})
+        await other.revoke_token("t4", now + 60)
+        await revocations.sync()
+        assert await revocations.is_revoked({"sub": "v", "jti": "t4", "iat": now})
+    asyncio.run(run())
@@ -0,0 +1,202 @@
+import asyncio
+import hashlib
+import json
+import time
+import types
+import pytest
+import store as store_module
+from store import CompactSerializer, FilesystemStore, SessionSerializer, SQLiteStore, ThrottledStore
+
+
+class SlowStore:
+    """Counts writes, and takes a while over each so that concurrent writes overlap."""
+
+    def __init__(self, data=b""):
+        self.data = data
+        self.writes = 0
+
+    async def read(self, session_id, lifetime):
+        return self.data
+
+    async def write(self, session_id, data, lifetime, ttl):
+        self.writes += 1
+        await asyncio.sleep(0.01)
+        self.data = data
+        return session_id
+
+    async def remove(self, session_id):
+        self.data = b""
+
+
+def test_throttled_store_skips_unchanged_writes():
+    async def run():
+        backing = SlowStore()
+        store = ThrottledStore(backing, refresh_interval=300)
+        await store.write("s", b"a", 1000, 1000)
+        await store.write("s", b"a", 1000, 1000)
+        assert backing.writes == 1
+        await store.write("s", b"b", 1000, 1000)
+        assert backing.writes == 2
+        # A rolling expiry pushed out by more than refresh_interval is written
+        await store.write("s", b"b", 1000, 1400)
+        assert backing.writes == 3
+        assert store.stats() == {"writes": 3, "skipped_writes": 1}
+    asyncio.run(run())
+
+
+def test_throttled_store_writes_after_read_of_other_data():
+    async def run():
+        backing = SlowStore()
+        store = ThrottledStore(backing, refresh_interval=300)
+        await store.write("s", b"a", 1000, 1000)
+        backing.data = b"from another worker"
+        await store.read("s", 1000)
+        await store.write("s", b"a", 1000, 1000)
+        assert backing.writes == 2
+    asyncio.run(run())
+
+
+def test_throttled_store_coalesces_concurrent_identical_writes():
+    async def run():
+        backing = SlowStore(b"old")
+        store = ThrottledStore(backing)
+        await store.read("s", 1000)
+        ids = await asyncio.gather(*[store.write("s", b"new", 1000, 1000) for _ in range(10)])
+        assert ids == ["s"] * 10
+        assert backing.writes == 1
+        assert store.stats() == {"writes": 1, "skipped_writes": 9}
+    asyncio.run(run())
+
+
+def test_throttled_store_concurrent_different_writes_all_land():
+    async def run():
+        backing = SlowStore()
+        store = ThrottledStore(backing)
+        await asyncio.gather(*[store.write("s", b"%d" % i, 1000, 1000) for i in range(5)])
+        assert backing.writes == 5
+    asyncio.run(run())
+
+
+def test_compact_serializer_round_trip():
+    serializer = CompactSerializer(compress_threshold=64)
+    small = {"user_id": "abc", "__metadata__": {"lifetime": 10, "last_access": 123}}
+    data = serializer.serialize(small)
+    assert data[:1] == CompactSerializer.RAW
+    assert serializer.deserialize(data) == {"user_id": "abc", "__metadata__": {"lifetime": 10}}
+    large = {"access_token": "x" * 1000}
+    data = serializer.serialize(large)
+    assert data[:1] == CompactSerializer.COMPRESSED
+    assert len(data) < 1000
+    assert serializer.deserialize(data) == large
+
+
+def test_compact_serializer_reads_json_sessions():
+    session = {"user_id": "abc", "__metadata__": {"lifetime": 10}}
+    data = SessionSerializer().serialize(session)
+    assert json.loads(data) == session
+    assert CompactSerializer().deserialize(data) == session
+    assert CompactSerializer().deserialize(b"") == {}
+
+
+def test_serializers_ignore_last_access():
+    for serializer in (CompactSerializer(), SessionSerializer()):
+        a = serializer.serialize({"k": 1, "__metadata__": {"last_access": 1}})
+        b = serializer.serialize({"k": 1, "__metadata__": {"last_access": 2}})
+        assert a == b
+
+
+def test_filesystem_store_layout(tmp_path):
+    async def run():
+        store = FilesystemStore(tmp_path)
+        await store.write("session-id", b"data", 0, 60)
+        digest = hashlib.sha256(b"session-id").hexdigest()
+        path = tmp_path / digest[:2] / digest[2:4] / digest
+        assert store.session_file("session-id") == path
+        assert path.exists()
+        assert [p.name for p in path.parent.iterdir()] == [digest] # no temporary files left
+        assert await store.read("session-id", 0) == b"data"
+        assert await store.exists("session-id")
+        await store.remove("session-id")
+        assert not path.exists()
+        assert await store.read("session-id", 0) == b""
+    asyncio.run(run())
+
+
+def test_filesystem_store_failed_write_keeps_old_session(tmp_path, monkeypatch):
+    async def run():
+        store = FilesystemStore(tmp_path)
+        await store.write("s", b"old", 0, 60)
+
+        def fail(src, dst):
+            raise OSError("disk full")
+        monkeypatch.setattr(store_module.os, "replace", fail)
+        with pytest.raises(OSError):
+            await store.write("s", b"new", 0, 60)
+        monkeypatch.undo()
+        assert await store.read("s", 0) == b"old"
+        assert [p.name for p in store.session_file("s").parent.iterdir()] == [store.session_file("s").name]
+    asyncio.run(run())
+
+
+def test_filesystem_store_expiry(tmp_path):
+    async def run():
+        store = FilesystemStore(tmp_path, default_ttl=60)
+        await store.write("browser-session", b"data", 0, 0)
+        expires_at = store_module.HEADER.unpack_from(store.session_file("browser-session").read_bytes())[0]
+        assert time.time() + 50 < expires_at <= time.time() + 60
+        store._write(store.session_file("expired"), b"data", time.time() - 1)
+        assert not await store.exists("expired")
+        assert await store.read("expired", 0) == b""
+        assert not store.session_file("expired").exists() # deleted on read
+    asyncio.run(run())
+
+
+def test_filesystem_store_sweep(tmp_path, monkeypatch):
+    async def run():
+        store = FilesystemStore(tmp_path, sweep_batch=store_module.SHARDS)
+        await store.write("live", b"data", 0, 3600)
+        store._write(store.session_file("expired"), b"data", time.time() - 1)
+        shard = store.session_file("live").parent
+        (shard / ".tmp-recent").write_bytes(b"partial")
+        assert await store.sweep() == 1
+        assert store.session_file("live").exists()
+        assert not store.session_file("expired").exists()
+        assert (shard / ".tmp-recent").exists() # may be a write in progress
+        # Two minutes later, the temporary file is a leftover from a crashed write
+        later = time.time() + 120
+        monkeypatch.setattr(store_module, "time", types.SimpleNamespace(time=lambda: later))
+        assert await store.sweep() == 0
+        assert not (shard / ".tmp-recent").exists()
+        assert store.session_file("live").exists()
+    asyncio.run(run())
+
+
+def test_sqlite_store(tmp_path):
+    async def run():
+        store = SQLiteStore(tmp_path / "sessions.db", batch_window=0.001)
+        await asyncio.gather(*[store.write(f"s{i}", b"data%d" % i, 0, 60) for i in range(20)])
+        assert await store.read("s3", 0) == b"data3"
+        assert await store.exists("s3")
+        await store.remove("s3")
+        assert await store.read("s3", 0) == b""
+        await store.write("expired", b"x", 0, 60)
+        store._query("UPDATE sessions SET expires_at = ? WHERE id = 'expired'", (time.time() - 1,))
+        assert await store.read("expired", 0) == b""
+        assert await store.sweep() == 1
+    asyncio.run(run())
+
+
+def test_sqlite_store_revoke_user(tmp_path):
+    async def run():
+        store = SQLiteStore(tmp_path / "sessions.db", batch_window=0.001)
+        for session_id in ("a", "b"):
+            await store.index_user(session_id, "user")
+            await store.write(session_id, b"data", 0, 60)
+        assert sorted(await store.user_sessions("user")) == ["a", "b"]
+        assert await store.revoke_user("user") == 2
+        assert await store.read("a", 0) == b""
+        # A request that was in flight during the revocation cannot save the session back
+        await store.write("a", b"data", 0, 60)
+        assert await store.read("a", 0) == b""
+        assert await store.user_sessions("user") == []
+    asyncio.run(run())
@@ -0,0 +1,173 @@
+import asyncio
+import json
+import time
+import types
+import httpx
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+import backends
+import tokens
+from fusion import ClientResponse
+from resilience import UpstreamUnavailable
+from tokens import NoLocalKeyError, TokenVerifier
+
+
+AUDIENCE = "test-app"
+SECRET = "an-hmac-secret-of-at-least-32-bytes"
+
+
+def rsa_key(kid):
+    private = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(RSAAlgorithm.to_jwk(private.public_key()))
+    jwk.update(kid=kid, alg="RS256", use="sig")
+    return private, jwk
+
+
+KEY1, JWK1 = rsa_key("k1")
+KEY2, JWK2 = rsa_key("k2")
+
+
+def sign(key, kid, **claims):
+    claims = {"sub": "u1", "aud": AUDIENCE, "exp": int(time.time()) + 60, **claims}
+    return jwt.encode(claims, key, algorithm="RS256", headers={"kid": kid})
+
+
+class JWKSClient:
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.down = False
+        self.calls = 0
+
+    async def retrieve_json_web_key_set(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.down:
+            raise UpstreamUnavailable("jwks", "timeout")
+        return ClientResponse(httpx.Response(200, json={"keys": self.keys}))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    # Only the verifier's clock; asyncio's own must keep running
+    monkeypatch.setattr(tokens, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def verify(verifier, token, **kwargs):
+    return asyncio.run(verifier.verify(token, **kwargs))
+
+
+def test_verifies_with_jwks_key():
+    client = JWKSClient([JWK1])
+    verifier = TokenVerifier(client, audience=AUDIENCE)
+    assert verify(verifier, sign(KEY1, "k1"))["sub"] == "u1"
+    assert verify(verifier, sign(KEY1, "k1"))["sub"] == "u1"
+    assert client.calls == 1
+    with pytest.raises(jwt.InvalidAudienceError):
+        verify(verifier, sign(KEY1, "k1", aud="other-app"))
+    with pytest.raises(jwt.InvalidSignatureError):
+        verify(verifier, sign(KEY2, "k1"))
+
+
+def test_rejects_none_and_unknown_algorithms():
+    verifier = TokenVerifier(JWKSClient([JWK1]), audience=AUDIENCE, hmac_secret=SECRET)
+    unsigned = jwt.encode({"sub": "u1", "aud": AUDIENCE, "exp": int(time.time()) + 60}, None, algorithm="none")
+    with pytest.raises(jwt.InvalidAlgorithmError):
+        verify(verifier, unsigned)
+    header = jwt.utils.base64url_encode(json.dumps({"alg": "XX999", "typ": "JWT"}).encode()).decode()
+    forged = header + "." + unsigned.split(".", 2)[1] + ".c2ln"
+    with pytest.raises(jwt.InvalidAlgorithmError):
+        verify(verifier, forged)
+
+
+def test_unknown_kid_refetches_at_most_every_min_refresh_interval(clock):
+    client = JWKSClient([JWK1])
+    verifier = TokenVerifier(client, audience=AUDIENCE, min_refresh_interval=30)
+    verify(verifier, sign(KEY1, "k1"))
+    client.keys = [JWK1, JWK2] # key rotation in FusionAuth
+    clock[0] += 10
+    with pytest.raises(jwt.InvalidTokenError):
+        verify(verifier, sign(KEY2, "k2"))
+    assert client.calls == 1 # rate limited: junk kids cannot hammer FusionAuth
+    clock[0] += 30
+    assert verify(verifier, sign(KEY2, "k2"))["sub"] == "u1"
+    assert client.calls == 2
+    with pytest.raises(jwt.InvalidTokenError):
+        verify(verifier, sign(KEY1, "junk"))
+    assert client.calls == 2
+
+
+def test_retries_after_failed_fetch(clock):
+    client = JWKSClient([JWK1])
+    client.down = True
+    verifier = TokenVerifier(client, audience=AUDIENCE, min_refresh_interval=30)
+    with pytest.raises(jwt.InvalidTokenError):
+        verify(verifier, sign(KEY1, "k1"))
+    assert client.calls == 1
+    client.down = False
+    clock[0] += 1 # well within min_refresh_interval
+    assert verify(verifier, sign(KEY1, "k1"))["sub"] == "u1"
+    assert client.calls == 2
+
+
+def test_concurrent_requests_share_failed_fetch():
+    client = JWKSClient([JWK1])
+    client.down = True
+    verifier = TokenVerifier(client, audience=AUDIENCE)
+    token = sign(KEY1, "k1")
+
+    async def run():
+        return await asyncio.gather(*[verifier.verify(token) for _ in range(10)], return_exceptions=True)
+    results = asyncio.run(run())
+    assert all(isinstance(r, jwt.InvalidTokenError) for r in results)
+    assert client.calls == 1
+
+
+def test_expiry_leeway():
+    verifier = TokenVerifier(JWKSClient([]), audience=AUDIENCE, hmac_secret=SECRET, leeway=5)
+    token = jwt.encode({"sub": "u1", "aud": AUDIENCE, "exp": int(time.time()) - 2}, SECRET, algorithm="HS256")
+    assert verify(verifier, token)["sub"] == "u1"
+    with pytest.raises(jwt.ExpiredSignatureError):
+        verify(verifier, token, leeway=0)
+    old = jwt.encode({"sub": "u1", "aud": AUDIENCE, "exp": int(time.time()) - 60}, SECRET, algorithm="HS256")
+    with pytest.raises(jwt.ExpiredSignatureError):
+        verify(verifier, old)
+    assert verify(verifier, old, leeway=300)["sub"] == "u1"
+
+
+def test_hmac_token_without_secret():
+    verifier = TokenVerifier(JWKSClient([]), audience=AUDIENCE)
+    token = jwt.encode({"sub": "u1", "aud": AUDIENCE, "exp": int(time.time()) + 60}, SECRET, algorithm="HS256")
+    with pytest.raises(NoLocalKeyError):
+        verify(verifier, token)
+
+
+class JWTClient:
+
+    def __init__(self, status):
+        self.status = status
+        self.calls = 0
+
+    async def retrieve_user_using_jwt(self, token):
+        self.calls += 1
+        return ClientResponse(httpx.Response(self.status, json={"user": {"id": "u1"}}))
+
+
+@pytest.mark.parametrize("status, accepted", [(200, True), (401, False)])
+def test_no_local_key_falls_back_to_fusionauth(monkeypatch, status, accepted):
+    client = JWTClient(status)
+    monkeypatch.setattr(backends, "client", client)
+    monkeypatch.setattr(backends.token_verifier, "hmac_secret", None)
+    token = jwt.encode({"sub": "u1", "aud": backends.CLIENT_ID, "exp": int(time.time()) + 60},
+        "unknown-secret-" + SECRET, algorithm="HS256")
+    if accepted:
+        assert asyncio.run(backends.verify_access_token(token))["sub"] == "u1"
+    else:
+        # Counted as expired, so that authenticate tries a refresh
+        with pytest.raises(jwt.ExpiredSignatureError):
+            asyncio.run(backends.verify_access_token(token))
+    assert client.calls == 1
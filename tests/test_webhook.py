@@ -0,0 +1,77 @@
+import pytest
+from starlette.testclient import TestClient
+import backends
+import main
+
+
+class RecordingStore:
+    supports_user_index = True
+
+    def __init__(self):
+        self.revoked = []
+
+    async def revoke_user(self, user_id):
+        self.revoked.append(user_id)
+
+
+class RecordingRevocations:
+
+    def __init__(self):
+        self.revoked = []
+
+    async def revoke_user(self, user_id, include_current_second=False):
+        assert include_current_second
+        self.revoked.append(user_id)
+
+
+@pytest.fixture
+def webhook(monkeypatch):
+    store = RecordingStore()
+    revocations = RecordingRevocations()
+    monkeypatch.setattr(main, "FUSIONAUTH_WEBHOOK_SECRET", "secret")
+    monkeypatch.setattr(main, "session_store", store)
+    monkeypatch.setattr(main, "USE_TOKENS", True)
+    monkeypatch.setattr(backends, "revocations", revocations)
+    client = TestClient(main.app)
+
+    def post(event, authorization="secret"):
+        return client.post("/webhooks/fusionauth", json={"event": event}, headers={"Authorization": authorization})
+    post.revoked = lambda: (store.revoked, revocations.revoked)
+    return post
+
+
+def test_webhook_requires_secret(webhook, monkeypatch):
+    event = {"type": "user.delete", "user": {"id": "u1"}}
+    assert webhook(event, authorization="wrong").status_code == 401
+    monkeypatch.setattr(main, "FUSIONAUTH_WEBHOOK_SECRET", None)
+    assert webhook(event).status_code == 403
+    assert webhook.revoked() == ([], [])
+
+
+def test_webhook_rejects_malformed_events(webhook):
+    assert webhook({"type": 5, "user": {"id": "u1"}}).status_code == 400
+    assert webhook({"type": "user.update", "user": "u1"}).status_code == 400
+    assert webhook({"type": "user.registration.delete", "user": {"id": "u1"}, "registration": "x"}).status_code == 400
+
+
+def test_webhook_revokes_deleted_users(webhook):
+    assert webhook({"type": "user.deactivate", "user": {"id": "u1"}}).status_code == 200
+    assert webhook({"type": "user.update", "user": {"id": "u2"}}).status_code == 200
+    assert webhook.revoked() == (["u1"], ["u1"])
+
+
+def test_webhook_registration_delete_only_for_this_app(webhook):
+    other = {"type": "user.registration.delete", "user": {"id": "u1"}, "applicationId": "some-other-app",
+        "registration": {"applicationId": "some-other-app"}}
+    assert webhook(other).status_code == 200
+    assert webhook.revoked() == ([], [])
+    ours = {"type": "user.registration.delete", "user": {"id": "u2"},
+        "registration": {"applicationId": backends.CLIENT_ID}}
+    assert webhook(ours).status_code == 200
+    assert webhook.revoked() == (["u2"], ["u2"])
+
+
+def test_webhook_evicts_cached_user(webhook):
+    backends.user_cache.set("u3", object())
+    webhook({"type": "user.registration.update", "user": {"id": "u3"}, "applicationId": "some-other-app"})
+    assert backends.user_cache.get("u3") is None
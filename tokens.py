@@ -0,0 +1,110 @@
+"""
+Local verification of FusionAuth access tokens.
+
+FusionAuth access tokens are signed JWTs, so with `USE_TOKENS = True` there is no need to
+ask FusionAuth whether a token is valid on every request. The public keys are fetched
+from the JWKS endpoint (/.well-known/jwks.json) and cached. They are re-fetched
+periodically, and early when a token arrives signed with a key id we have not seen
+(i.e. after a key rotation in FusionAuth).
+
+JWKS only publishes asymmetric keys. If the application's access token signing key is
+an HMAC key (FusionAuth's default), provide its secret as `hmac_secret`. Without it,
+HMAC signed tokens raise NoLocalKeyError, and have to be checked with FusionAuth.
+"""
+import asyncio
+import time
+import jwt
+from resilience import UpstreamUnavailable
+
+
+ASYMMETRIC_ALGORITHMS = ["RS256", "RS384", "RS512", "ES256", "ES384", "ES512", "PS256", "PS384", "PS512"]
+HMAC_ALGORITHMS = ["HS256", "HS384", "HS512"]
+
+
+class NoLocalKeyError(jwt.InvalidTokenError):
+    """The token is HMAC signed, and no `hmac_secret` was given to verify it with."""
+
+
+class TokenVerifier:
+
+    def __init__(self, client, *, audience, issuer=None, hmac_secret=None,
+            refresh_interval=3600, min_refresh_interval=30, leeway=5):
+        """`refresh_interval` is how often the key set is re-fetched regardless.
+        `min_refresh_interval` rate limits the early re-fetch triggered by an unknown key
+        id so that junk tokens cannot be used to hammer FusionAuth.
+        """
+        self.client = client
+        self.audience = audience
+        self.issuer = issuer
+        self.hmac_secret = hmac_secret
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.leeway = leeway
+        self._keys = {} # kid -> PyJWK
+        self._fetched_at = None # last successful fetch
+        self._attempted_at = None
+        self._lock = asyncio.Lock()
+
+    async def refresh_keys(self, force=False):
+        requested = time.monotonic()
+        async with self._lock:
+            if self._attempted_at is not None and self._attempted_at >= requested:
+                return # fetched, or tried, by another request while this one waited
+            now = time.monotonic()
+            if self._fetched_at is not None:
+                age = now - self._fetched_at
+                if age < self.min_refresh_interval or (not force and age < self.refresh_interval):
+                    return
+            # On failure we keep serving the keys we have, and the next request that
+            # needs a key tries again
+            try:
+                resp = await self.client.retrieve_json_web_key_set()
+            except UpstreamUnavailable:
+                return
+            finally:
+                self._attempted_at = time.monotonic()
+            if not resp.was_successful():
+                return
+            keys = {}
+            for jwk in resp.success_response.get("keys", []):
+                try:
+                    keys[jwk["kid"]] = jwt.PyJWK(jwk)
+                except (KeyError, jwt.PyJWKError):
+                    continue # unsupported key type; tokens signed with it will not verify
+            self._keys = keys
+            self._fetched_at = now
+
+    async def get_key(self, header):
+        alg = header.get("alg")
+        if alg in HMAC_ALGORITHMS:
+            if self.hmac_secret is None:
+                raise NoLocalKeyError("HMAC signed token but no hmac_secret configured")
+            return self.hmac_secret
+        if alg not in ASYMMETRIC_ALGORITHMS:
+            raise jwt.InvalidAlgorithmError(f"Unsupported algorithm: {alg}")
+        kid = header.get("kid")
+        if self._fetched_at is None or time.monotonic() - self._fetched_at >= self.refresh_interval:
+            await self.refresh_keys()
+        elif kid not in self._keys:
+            await self.refresh_keys(force=True)
+        if kid not in self._keys:
+            raise jwt.InvalidTokenError(f"Unknown signing key: {kid}")
+        return self._keys[kid].key
+
+    async def verify(self, token, leeway=None):
+        """Return the verified claims of `token`. `leeway` (seconds) overrides the
+        leeway for the expiry given to the constructor.
+
+        Raises jwt.ExpiredSignatureError for an otherwise valid but expired token, and
+        another jwt.InvalidTokenError for anything else wrong with it.
+        """
+        header = jwt.get_unverified_header(token)
+        key = await self.get_key(header)
+        return jwt.decode(
+            token,
+            key,
+            algorithms=[header["alg"]],
+            audience=self.audience,
+            issuer=self.issuer,
+            leeway=self.leeway if leeway is None else leeway,
+            options={"require": ["exp", "sub"]})
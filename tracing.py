@@ -0,0 +1,134 @@
+"""
+Per-request tracing of the auth pipeline.
+
+Where the metrics in metrics.py show aggregates, this shows where the time went in one
+particular request. For a sampled request, code wrapped in `span(name)` is timed, and
+the spans are sent back in a `Server-Timing` response header (shown in the browser's
+dev tools network tab). They can optionally also be logged as one JSON line per request
+with a request id.
+
+Sampling is decided once per request. For requests that are not sampled, `span` does
+nothing beyond a context variable lookup.
+"""
+import contextvars
+import json
+import logging
+import random
+import time
+import uuid
+from starlette.datastructures import MutableHeaders
+
+
+logger = logging.getLogger("tracing")
+
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+class _Span:
+    __slots__ = ("trace", "name", "start")
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.append((self.name, self.start - self.trace.start, time.perf_counter() - self.start))
+
+
+class _NoopSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class Trace(list):
+    """The spans of one request, as (name, offset, duration) tuples in seconds."""
+
+    def __init__(self, request_id):
+        super().__init__()
+        self.request_id = request_id
+        self.start = time.perf_counter()
+
+
+def span(name):
+    """Context manager timing the enclosed code as `name` if this request is traced."""
+    trace = _trace.get()
+    if trace is None:
+        return _NOOP
+    return _Span(trace, name)
+
+
+class TracingMiddleware:
+    """Traces a random `sample_rate` fraction of requests. Add it as the outermost
+    middleware so that the session write, which happens while the response is being
+    sent, is included.
+
+    The request id is taken from the `X-Request-Id` request header if present, and
+    returned in the same response header.
+    """
+
+    def __init__(self, app, sample_rate=0.0, log=False):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.log = log
+        if log and not logger.handlers:
+            # Nothing configures this logger (uvicorn only sets up its own), and the
+            # root logger drops INFO. Write trace lines to stderr unless the app has
+            # set up logging for "tracing" itself.
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.sample_rate or random.random() >= self.sample_rate:
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for key, value in scope["headers"]:
+            if key == b"x-request-id":
+                request_id = value.decode("latin-1")
+                break
+        trace = Trace(request_id or uuid.uuid4().hex)
+        token = _trace.set(trace)
+        status = None
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                total = time.perf_counter() - trace.start
+                timings = [f"{name};dur={duration * 1000:.2f}" for name, _, duration in trace]
+                timings.append(f"total;dur={total * 1000:.2f}")
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", ", ".join(timings))
+                headers.append("X-Request-Id", trace.request_id)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _trace.reset(token)
+            if self.log:
+                logger.info(json.dumps({
+                    "request_id": trace.request_id,
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status,
+                    "duration_ms": round((time.perf_counter() - trace.start) * 1000, 3),
+                    "spans": [
+                        {"name": name, "offset_ms": round(offset * 1000, 3), "duration_ms": round(duration * 1000, 3)}
+                        for name, offset, duration in trace],
+                }))